@@ -11,6 +11,9 @@ except ImportError as ex:
 import sys
 import os.path
 import re
+import pickle
+import json
+from concurrent.futures import ProcessPoolExecutor
 
 # path -> Binary()
 binaries = {}
@@ -21,9 +24,21 @@ show_fullpath = False
 show_lines = True
 show_used_symbols = False
 max_depth = 0
+expand_once = False
+# (reverse, Binary()) -> id of its first complete expansion, see expand_once
+expanded = {}
+last_expansion_id = 0
 
 ignore_missing_symbol_regex = re.compile(r"^(_dl_starting_up)$")
 ignore_symbol_regex = None
+elf_cache = None
+# realpath -> read_elf_info(), filled by prefetch_elf_info()
+elf_infos = {}
+# symbol name -> Binary() defining it, see build_symbol_index()
+symbol_providers = None
+default_cache_file = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "show-deps", "elf-cache.pickle")
 
 class DependencyError(Exception):
     def __init__(self, binary, needed, search_paths):
@@ -36,16 +51,17 @@ class DependencyError(Exception):
 
 class Binary(object):
     __slots__ = ("dirname", "basename", "realpath", "aliases", "needs",
-                 "needed_by", "symbols", "needs_symbols",
+                 "needs_order", "needed_by", "symbols", "needs_symbols",
                  "needs_symbols_providers", "symbols_users",
                  "_resolve_needed_symbols")
 
-    def __init__(self, dirname, basename, realpath, elf):
+    def __init__(self, dirname, basename, realpath, info):
         self.dirname = dirname
         self.basename = basename
         self.realpath = realpath
         self.aliases = set()
         self.needs = set()
+        self.needs_order = [] # as DT_NEEDED, used as loader search order
         self.needed_by = set()
         self.symbols = None
         self.needs_symbols = None
@@ -56,76 +72,85 @@ class Binary(object):
         global binaries
         binaries[self.realpath] = self
 
-        dt = elf.get_section_by_name(".dynamic")
-        if not dt:
+        if not info["dynamic"]:
             return
 
-        def _search_paths():
-            for rpath in dt.iter_tags("DT_RPATH"):
-                for d in rpath.rpath.split(":"):
-                    yield os.path.realpath(sysroot + d)
-
-            for d in lib_search_paths:
-                yield d
-
-
-        for tag in dt.iter_tags("DT_NEEDED"):
-            needed = tag.needed
+        for needed in info["needed"]:
             if needed.startswith(os.path.sep):
                 dep = self.try_binary(sysroot + needed)
                 continue
 
             dep = None
-            for d in _search_paths():
+            for d in search_paths(info["rpath"]):
                 deppath = os.path.join(d, needed)
                 try:
                     dep = self.try_binary(deppath)
+                    if dep not in self.needs:
+                        self.needs_order.append(dep)
                     self.needs.add(dep)
                     dep.needed_by.add(self)
                     break
                 except FileNotFoundError:
                     continue
             else:
-                raise DependencyError(self, needed, _search_paths())
+                raise DependencyError(self, needed,
+                                      search_paths(info["rpath"]))
 
         if not show_used_symbols:
             return
 
-        symtab = elf.get_section_by_name(".dynsym")
-        if not symtab:
+        if info["symbols"] is None:
             print("INFO: {} has no .dynsym".format(self.realpath))
             return
 
-        symbols = set()
-        needs_symbols = set()
-        for sym in symtab.iter_symbols():
-            symname = sym.name
-            if not symname:
-                continue
-            if sym["st_shndx"] != "SHN_UNDEF":
-                symbols.add(symname)
-            else:
-                needs_symbols.add(symname)
+        self.symbols = info["symbols"]
+        self.needs_symbols = info["needs_symbols"]
 
-        self.symbols = tuple(sorted(symbols))
-        self.needs_symbols = tuple(sorted(needs_symbols))
+
+    def load_order(self):
+        """Dependencies in the order the dynamic loader searches them
+        for symbols: breadth-first over DT_NEEDED.
+        """
+        order = []
+        seen = set((self,))
+        queue = [self]
+        for b in queue:
+            for dep in b.needs_order:
+                if dep not in seen:
+                    seen.add(dep)
+                    order.append(dep)
+                    queue.append(dep)
+        return order
 
 
     def resolve_needed_symbols(self):
         if self._resolve_needed_symbols >= 0:
             return self._resolve_needed_symbols
 
+        global symbol_providers
+        if symbol_providers is None:
+            symbol_providers = build_symbol_index()
+
+        rank = {}
+        for i, dep in enumerate(self.load_order()):
+            rank[dep] = i
+
         missing = 0
-        for symname in self.needs_symbols:
-            for dep in self.needs:
-                if symname in dep.symbols:
-                    self.needs_symbols_providers[symname] = dep
-                    dep.symbols_users.setdefault(symname, set()).add(self)
-                    break
-            else:
-                if not ignore_missing_symbol_regex.match(symname):
-                    self.needs_symbols_providers[symname] = None
-                    missing += 1
+        for symname in self.needs_symbols or ():
+            provider = None
+            provider_rank = None
+            for dep in symbol_providers.get(symname, ()):
+                r = rank.get(dep)
+                if r is not None and (provider is None or r < provider_rank):
+                    provider = dep
+                    provider_rank = r
+
+            if provider is not None:
+                self.needs_symbols_providers[symname] = provider
+                provider.symbols_users.setdefault(symname, set()).add(self)
+            elif not ignore_missing_symbol_regex.match(symname):
+                self.needs_symbols_providers[symname] = None
+                missing += 1
         self._resolve_needed_symbols = missing
         return missing
 
@@ -142,126 +167,331 @@ class Binary(object):
                     binaries[path] = b
             return b
 
-        with open(realpath, "rb") as f:
-            elf = ELFFile(f)
-            dname, bname = os.path.split(realpath)
-            b = cls(dname, bname, realpath, elf)
-            if path != realpath:
-                b.aliases.add(path)
-                binaries[path] = b
-            return b
-
+        info = get_elf_info(realpath)
+        dname, bname = os.path.split(realpath)
+        b = cls(dname, bname, realpath, info)
+        if path != realpath:
+            b.aliases.add(path)
+            binaries[path] = b
+        return b
+
+
+def build_symbol_index():
+    """Map each defined symbol name to the binaries providing it, done
+    once for the whole graph instead of searching each dependency.
+    """
+    index = {}
+    for b in set(binaries.values()):
+        for symname in b.symbols or ():
+            providers = index.get(symname)
+            if providers is None:
+                index[symname] = [b]
+            else:
+                providers.append(b)
+    return index
+
+
+def read_elf_info(path, read_symbols=True):
+    """Parse what Binary() needs from ELF file: DT_NEEDED, DT_RPATH
+    and, if read_symbols, .dynsym defined (symbols) and undefined
+    (needs_symbols) names. Reading symbols is by far the slowest part.
+    """
+    info = {"dynamic": False, "needed": (), "rpath": (),
+            "symbols_read": read_symbols,
+            "symbols": None, "needs_symbols": None}
+    with open(path, "rb") as f:
+        elf = ELFFile(f)
+        dt = elf.get_section_by_name(".dynamic")
+        if not dt:
+            return info
+        info["dynamic"] = True
 
-def show_deps(b, parent_prefix, is_last, stack):
-    if show_fullpath:
-        path = b.realpath
-    else:
-        path = b.realpath[len(sysroot):]
+        rpath = []
+        for tag in dt.iter_tags("DT_RPATH"):
+            rpath.extend(tag.rpath.split(":"))
+        info["rpath"] = tuple(rpath)
+        info["needed"] = tuple(tag.needed for tag in dt.iter_tags("DT_NEEDED"))
 
-    children = list(b.needs)
-    children.sort(key=lambda x: x.realpath)
-    if ignore_libc_regex:
-        for dep in b.needs:
-            if ignore_libc_regex.match(dep.basename):
-                children.remove(dep)
+        if not read_symbols:
+            return info
 
-    depth_limited = max_depth and len(stack) == max_depth
-    cyclic = b in stack
-    show_children = children and not cyclic and not depth_limited
+        symtab = elf.get_section_by_name(".dynsym")
+        if not symtab:
+            return info
 
-    if not parent_prefix:
-        local_prefix = ""
-    else:
-        if not show_lines:
-            local_prefix = ""
-        else:
-            if is_last:
-                local_prefix = "└"
+        symbols = set()
+        needs_symbols = set()
+        for sym in symtab.iter_symbols():
+            symname = sym.name
+            if not symname:
+                continue
+            if sym["st_shndx"] != "SHN_UNDEF":
+                symbols.add(symname)
             else:
-                local_prefix = "├"
+                needs_symbols.add(symname)
 
-            if show_children:
-                local_prefix += "─┬─ "
-            else:
-                local_prefix += "─── "
+        info["symbols"] = tuple(sorted(symbols))
+        info["needs_symbols"] = tuple(sorted(needs_symbols))
+    return info
 
-    note = ""
-    if cyclic:
-        note = " [cyclic-dependency, stop recursion]"
 
-    print("{}{}{}{}".format(parent_prefix, local_prefix, path, note))
+def search_paths(rpath):
+    for d in rpath:
+        yield os.path.realpath(sysroot + d)
 
-    if not show_lines:
-        sub_prefix = parent_prefix + " "
-    else:
-        if is_last:
-            sub_prefix = parent_prefix + "  "
-        elif parent_prefix:
-            sub_prefix = parent_prefix + "│ "
-        else:
-            sub_prefix = parent_prefix + "  "
+    for d in lib_search_paths:
+        yield d
 
-    if show_used_symbols:
-        b.resolve_needed_symbols()
 
-        if show_children and show_lines:
-            sym_prefix = "│"
-        else:
-            sym_prefix = " "
+class ElfCache(object):
+    """On-disk cache of read_elf_info() results.
 
-        missing_symbols = []
-        for symname, provider in b.needs_symbols_providers.items():
-            if ignore_symbol_regex and ignore_symbol_regex.match(symname):
-                continue
-            if provider is not None:
-                continue
-            missing_symbols.append(symname)
+    Entries are keyed by realpath and are valid while inode, mtime and
+    size are the same, so unchanged files are not parsed again. Entries
+    without symbols are parsed again if show_used_symbols. Entries not
+    looked up during the run are dropped on save(), so the cache does
+    not grow with files no longer used or gone.
+    """
+    version = 2
 
-        if missing_symbols:
-            print("{}{} missing symbols:".format(sub_prefix, sym_prefix))
-            missing_symbols.sort()
-            for symname in missing_symbols:
-                print("{}{}  ! {}".format(sub_prefix, sym_prefix, symname))
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.checked = set()
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+        self.load()
 
-        if stack:
-            u = stack[-1]
-            used_symbols = []
-            for symname, users in b.symbols_users.items():
-                if ignore_symbol_regex and ignore_symbol_regex.match(symname):
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                version, entries = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as ex:
+            print("WARNING: ignored invalid cache {}: {}".format(self.path, ex))
+            return
+        if version == self.version:
+            self.entries = entries
+
+    def prune(self):
+        """Drop entries not looked up since load()."""
+        unchecked = [p for p in self.entries if p not in self.checked]
+        for p in unchecked:
+            del self.entries[p]
+        if unchecked:
+            self.changed = True
+
+    def save(self):
+        self.prune()
+        if not self.changed:
+            return
+        d = os.path.dirname(self.path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump((self.version, self.entries), f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+        self.changed = False
+
+    def lookup(self, realpath):
+        """Returns (stamp, info), info is None if not cached or stale."""
+        st = os.stat(realpath)
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        self.checked.add(realpath)
+        entry = self.entries.get(realpath)
+        if entry and entry[0] == stamp and \
+           (entry[1]["symbols_read"] or not show_used_symbols):
+            self.hits += 1
+            return stamp, entry[1]
+        self.misses += 1
+        return stamp, None
+
+    def store(self, realpath, stamp, info):
+        self.entries[realpath] = (stamp, info)
+        self.checked.add(realpath)
+        self.changed = True
+
+    def get(self, realpath):
+        stamp, info = self.lookup(realpath)
+        if info is None:
+            info = read_elf_info(realpath, show_used_symbols)
+            self.store(realpath, stamp, info)
+        return info
+
+
+def get_elf_info(realpath):
+    info = elf_infos.get(realpath)
+    if info is not None:
+        return info
+    if elf_cache is not None:
+        return elf_cache.get(realpath)
+    return read_elf_info(realpath, show_used_symbols)
+
+
+def _read_elf_info_job(realpath, read_symbols):
+    try:
+        return read_elf_info(realpath, read_symbols)
+    except Exception:
+        return None # Binary.try_binary() will report it
+
+
+def prefetch_elf_info(paths, jobs=None):
+    """Parse ELF files reachable from paths using a process pool.
+
+    Each level of dependencies is found from the previous one (using
+    the same search paths as Binary) and is parsed in parallel, results
+    go to elf_infos and elf_cache. The graph is then built by
+    Binary.try_binary() without parsing files. Failures are ignored
+    here, they are parsed and reported again by Binary.try_binary().
+    """
+    jobs = jobs or os.cpu_count() or 1
+    seen = set()
+    todo = [os.path.realpath(p) for p in paths]
+    with ProcessPoolExecutor(jobs) as executor:
+        while todo:
+            level = []
+            parse = []
+            stamps = []
+            for realpath in todo:
+                if realpath in seen:
                     continue
-                if u in users:
-                    used_symbols.append(symname)
-
-            if used_symbols:
-                print("{}{} used symbols:".format(sub_prefix, sym_prefix))
-                used_symbols.sort()
-                for symname in used_symbols:
-                    print("{}{}  * {}".format(sub_prefix, sym_prefix, symname))
-
-    if not show_children:
-        return
-    last = len(children) - 1
-    for i, d in enumerate(children):
-        show_deps(d, sub_prefix, i == last, stack + (b,))
+                seen.add(realpath)
+                try:
+                    if elf_cache is not None:
+                        stamp, info = elf_cache.lookup(realpath)
+                    else:
+                        stamp, info = None, None
+                except OSError:
+                    continue
+                level.append(realpath)
+                if info is not None:
+                    elf_infos[realpath] = info
+                else:
+                    parse.append(realpath)
+                    stamps.append(stamp)
+
+            chunksize = max(1, len(parse) // (4 * jobs))
+            results = executor.map(_read_elf_info_job, parse,
+                                   [show_used_symbols] * len(parse),
+                                   chunksize=chunksize)
+            for realpath, stamp, info in zip(parse, stamps, results):
+                if info is None:
+                    continue
+                elf_infos[realpath] = info
+                if elf_cache is not None:
+                    elf_cache.store(realpath, stamp, info)
+
+            todo = []
+            for realpath in level:
+                info = elf_infos.get(realpath)
+                if not info:
+                    continue
+                for needed in info["needed"]:
+                    if needed.startswith(os.path.sep):
+                        todo.append(os.path.realpath(sysroot + needed))
+                        continue
+                    for d in search_paths(info["rpath"]):
+                        deppath = os.path.join(d, needed)
+                        if os.path.exists(deppath):
+                            todo.append(os.path.realpath(deppath))
+                            break
+
+
+def binary_path(b):
+    if show_fullpath:
+        return b.realpath
+    return b.realpath[len(sysroot):]
 
 
-def show_deps_reverse(b, parent_prefix, is_last, stack):
-    if show_fullpath:
-        path = b.realpath
+def sorted_children(b, reverse=False):
+    if reverse:
+        deps = b.needed_by
     else:
-        path = b.realpath[len(sysroot):]
-
-    children = list(b.needed_by)
+        deps = b.needs
+    children = list(deps)
     children.sort(key=lambda x: x.realpath)
     if ignore_libc_regex:
-        for dep in b.needed_by:
+        for dep in deps:
             if ignore_libc_regex.match(dep.basename):
                 children.remove(dep)
+    return children
+
+
+def get_missing_symbols(b):
+    b.resolve_needed_symbols()
+    missing_symbols = []
+    for symname, provider in b.needs_symbols_providers.items():
+        if ignore_symbol_regex and ignore_symbol_regex.match(symname):
+            continue
+        if provider is not None:
+            continue
+        missing_symbols.append(symname)
+    missing_symbols.sort()
+    return missing_symbols
+
+
+def get_indirect_symbols(b):
+    """Symbols b takes from dependencies it does not directly need, as
+    sorted (symbol name, provider) pairs. These are not shown on any
+    parent -> child edge.
+    """
+    b.resolve_needed_symbols()
+    indirect_symbols = []
+    for symname, provider in b.needs_symbols_providers.items():
+        if ignore_symbol_regex and ignore_symbol_regex.match(symname):
+            continue
+        if provider is None or provider in b.needs:
+            continue
+        indirect_symbols.append((symname, provider))
+    indirect_symbols.sort(key=lambda x: x[0])
+    return indirect_symbols
+
+
+def get_used_symbols(provider, user):
+    user.resolve_needed_symbols()
+    used_symbols = []
+    for symname, users in provider.symbols_users.items():
+        if ignore_symbol_regex and ignore_symbol_regex.match(symname):
+            continue
+        if user in users:
+            used_symbols.append(symname)
+    used_symbols.sort()
+    return used_symbols
+
+
+def new_expansion_id():
+    global last_expansion_id
+    last_expansion_id += 1
+    return last_expansion_id
+
+
+def print_tree(b, parent_prefix, is_last, stack, reverse):
+    """Print b and its dependencies (or users, if reverse).
+
+    Returns whether the subtree was completely shown, that is, not
+    cut by max_depth. With expand_once only complete subtrees are
+    remembered in expanded, later ones just refer to it.
+    """
+    path = binary_path(b)
+    children = sorted_children(b, reverse)
 
     depth_limited = max_depth and len(stack) == max_depth
     cyclic = b in stack
     show_children = children and not cyclic and not depth_limited
 
+    ref = None
+    expansion_id = None
+    if expand_once and show_children:
+        ref = expanded.get((reverse, b))
+        if ref is not None:
+            show_children = False
+        else:
+            expansion_id = new_expansion_id()
+
     if not parent_prefix:
         local_prefix = ""
     else:
@@ -281,6 +511,10 @@ def show_deps_reverse(b, parent_prefix, is_last, stack):
     note = ""
     if cyclic:
         note = " [cyclic-dependency, stop recursion]"
+    elif ref is not None:
+        note = " [see #{}]".format(ref)
+    elif expansion_id is not None:
+        note = " [#{}]".format(expansion_id)
 
     print("{}{}{}{}".format(parent_prefix, local_prefix, path, note))
 
@@ -295,47 +529,186 @@ def show_deps_reverse(b, parent_prefix, is_last, stack):
             sub_prefix = parent_prefix + "  "
 
     if show_used_symbols:
-        b.resolve_needed_symbols()
-
         if show_children and show_lines:
             sym_prefix = "│"
         else:
             sym_prefix = " "
 
-        missing_symbols = []
-        for symname, provider in b.needs_symbols_providers.items():
-            if ignore_symbol_regex and ignore_symbol_regex.match(symname):
-                continue
-            if provider is not None:
-                continue
-            missing_symbols.append(symname)
-
+        if ref is not None:
+            missing_symbols = () # shown in the first expansion
+            indirect_symbols = ()
+        else:
+            missing_symbols = get_missing_symbols(b)
+            indirect_symbols = get_indirect_symbols(b)
         if missing_symbols:
             print("{}{} missing symbols:".format(sub_prefix, sym_prefix))
-            missing_symbols.sort()
             for symname in missing_symbols:
                 print("{}{}  ! {}".format(sub_prefix, sym_prefix, symname))
 
+        if indirect_symbols:
+            print("{}{} indirect symbols:".format(sub_prefix, sym_prefix))
+            for symname, provider in indirect_symbols:
+                print("{}{}  > {} ({})".format(sub_prefix, sym_prefix, symname,
+                                               binary_path(provider)))
+
         if stack:
-            p = stack[-1]
-            used_symbols = []
-            for symname, users in p.symbols_users.items():
-                if ignore_symbol_regex and ignore_symbol_regex.match(symname):
-                    continue
-                if b in users:
-                    used_symbols.append(symname)
+            if reverse:
+                used_symbols = get_used_symbols(stack[-1], b)
+            else:
+                used_symbols = get_used_symbols(b, stack[-1])
 
             if used_symbols:
                 print("{}{} used symbols:".format(sub_prefix, sym_prefix))
-                used_symbols.sort()
                 for symname in used_symbols:
                     print("{}{}  * {}".format(sub_prefix, sym_prefix, symname))
 
     if not show_children:
-        return
+        return not (depth_limited and children)
+    complete = True
     last = len(children) - 1
     for i, d in enumerate(children):
-        show_deps_reverse(d, sub_prefix, i == last, stack + (b,))
+        if not print_tree(d, sub_prefix, i == last, stack + (b,), reverse):
+            complete = False
+    if expansion_id is not None and complete:
+        expanded[(reverse, b)] = expansion_id
+    return complete
+
+
+def show_deps(b, parent_prefix, is_last, stack):
+    print_tree(b, parent_prefix, is_last, stack, False)
+
+
+def show_deps_reverse(b, parent_prefix, is_last, stack):
+    print_tree(b, parent_prefix, is_last, stack, True)
+
+
+def deps_tree(b, stack, reverse):
+    """Same as print_tree(), as nested dicts for JSON output.
+
+    Returns (node, complete). With expand_once, later references to a
+    complete subtree are {"path": ..., "ref": id} pointing to the node
+    with the same "id".
+    """
+    node = {"path": binary_path(b)}
+    children = sorted_children(b, reverse)
+
+    if b in stack:
+        node["cyclic"] = True
+        return node, True
+
+    ref = None
+    if expand_once and children:
+        ref = expanded.get((reverse, b))
+
+    if show_used_symbols:
+        if ref is None:
+            node["missing_symbols"] = get_missing_symbols(b)
+            node["indirect_symbols"] = dict(
+                (symname, binary_path(provider))
+                for symname, provider in get_indirect_symbols(b))
+        if stack:
+            if reverse:
+                node["used_symbols"] = get_used_symbols(stack[-1], b)
+            else:
+                node["used_symbols"] = get_used_symbols(b, stack[-1])
+
+    if max_depth and len(stack) == max_depth:
+        if children:
+            node["truncated"] = True
+            return node, False
+        return node, True
+
+    if ref is not None:
+        node["ref"] = ref
+        return node, True
+
+    expansion_id = None
+    if expand_once and children:
+        expansion_id = new_expansion_id()
+        node["id"] = expansion_id
+
+    complete = True
+    node["children"] = []
+    for d in children:
+        child, child_complete = deps_tree(d, stack + (b,), reverse)
+        node["children"].append(child)
+        if not child_complete:
+            complete = False
+    if expansion_id is not None and complete:
+        expanded[(reverse, b)] = expansion_id
+    return node, complete
+
+
+def find_elf_files(directory):
+    """Regular files (not symlinks) under directory starting with ELF
+    magic, sorted by path.
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        files.sort()
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            try:
+                with open(path, "rb") as f:
+                    magic = f.read(4)
+            except OSError:
+                continue
+            if magic == b"\x7fELF":
+                yield path
+
+
+def image_report(bins, errors):
+    """Forward and reverse trees of bins, the whole graph and a summary
+    of it, built in a single pass over the already loaded binaries.
+    """
+    unique = list(set(binaries.values()))
+    unique.sort(key=lambda x: x.realpath)
+
+    graph = {}
+    missing_total = 0
+    for b in unique:
+        entry = {
+            "aliases": sorted(a[len(sysroot):] for a in b.aliases),
+            "needs": [binary_path(d) for d in b.needs_order],
+            "needed_by": [binary_path(d) for d in sorted_children(b, True)],
+            }
+        if show_used_symbols:
+            entry["missing_symbols"] = get_missing_symbols(b)
+            missing_total += len(entry["missing_symbols"])
+            entry["indirect_symbols"] = dict(
+                (symname, binary_path(provider))
+                for symname, provider in get_indirect_symbols(b))
+        graph[binary_path(b)] = entry
+
+    roots = set(bins)
+    most_needed = [b for b in unique if b.needed_by]
+    most_needed.sort(key=lambda x: (-len(x.needed_by), x.realpath))
+    unneeded = [binary_path(b) for b in unique
+                if b in roots and not b.needed_by and ".so" in b.basename]
+
+    summary = {
+        "roots": len(bins),
+        "binaries": len(unique),
+        "libraries": len(most_needed),
+        "errors": len(errors),
+        "unneeded_libraries": unneeded,
+        "most_needed": [[binary_path(b), len(b.needed_by)]
+                        for b in most_needed[:20]],
+        }
+    if show_used_symbols:
+        summary["missing_symbols"] = missing_total
+
+    return {
+        "sysroot": sysroot,
+        "roots": [binary_path(b) for b in bins],
+        "forward": [deps_tree(b, (), False)[0] for b in bins],
+        "reverse": [deps_tree(b, (), True)[0] for b in bins],
+        "graph": graph,
+        "errors": errors,
+        "summary": summary,
+        }
 
 
 if __name__ == "__main__":
@@ -350,6 +723,9 @@ if __name__ == "__main__":
                     help="Do not show lines in output, just indent.")
     ap.add_argument("-d", "--max-depth", type=int, default=0,
                     help=("Maximum depth to recurse, default to 0 = unlimited"))
+    ap.add_argument("-e", "--expand-once", action="store_true",
+                    help=("Show dependencies of each binary only once, "
+                          "later occurrences refer to it as [see #N]"))
     ap.add_argument("-i", "--ignore-libc", action="store_true",
                     help=("Do not print libc and dynamic linker"))
     ap.add_argument("--ignore-symbol-regex",
@@ -357,22 +733,47 @@ if __name__ == "__main__":
     ap.add_argument("-S", "--sysroot", type=str, default=sysroot,
                     help="sysroot to prefix to all lookups")
     ap.add_argument("-f", "--fullpath", action="store_true",
-                    help=("Show full path, including -s/--sysroot"))
+                    help=("Show full path, including -S/--sysroot"))
     ap.add_argument("-u", "--used-symbols", action="store_true",
                     help="Show used symbols for each dependency.")
     ap.add_argument("-L", "--libdir", action="append",
                     help=("set libraries directories to search. "
                           "If none is given, tries an heuristic based "
                           "standard paths."))
-    ap.add_argument("binaries", nargs="+",
+    ap.add_argument("--cache", default=default_cache_file,
+                    help=("file to cache parsed ELF information, written "
+                          "at exit unless --no-cache, keeping just the "
+                          "files used in this run. Default: "
+                          "$XDG_CACHE_HOME/show-deps/elf-cache.pickle or "
+                          "~/.cache/show-deps/elf-cache.pickle, now "
+                          "%(default)s"))
+    ap.add_argument("--no-cache", action="store_true",
+                    help="Do not use cache, parse all ELF files.")
+    ap.add_argument("-j", "--jobs", type=int, default=1,
+                    help=("parse ELF files using this many processes, "
+                          "0 = number of CPUs, default %(default)s"))
+    ap.add_argument("-D", "--scan", action="append", default=[],
+                    help=("directory to search for ELF files (inside "
+                          "-S/--sysroot), all found are used as binaries. "
+                          "Use / to scan the whole sysroot"))
+    ap.add_argument("--json",
+                    help=("write forward and reverse trees, the whole graph "
+                          "and a summary to this JSON file instead of "
+                          "printing trees"))
+    ap.add_argument("binaries", nargs="*",
                     help="path to binary files to show dependencies")
     args = ap.parse_args()
+    if not args.binaries and not args.scan:
+        ap.error("no binaries given, use paths or -D/--scan")
+    if args.jobs < 0:
+        ap.error("-j/--jobs must be 0 (number of CPUs) or positive")
 
     sysroot = args.sysroot
 
     ret = 0
 
     max_depth = args.max_depth
+    expand_once = args.expand_once
     show_fullpath = args.fullpath
     show_lines = not args.no_lines
     show_used_symbols = args.used_symbols
@@ -383,6 +784,9 @@ if __name__ == "__main__":
     if args.ignore_symbol_regex:
         ignore_symbol_regex = re.compile(args.ignore_symbol_regex)
 
+    if not args.no_cache:
+        elf_cache = ElfCache(args.cache)
+
     if args.libdir:
         for d in args.libdir:
             path =  os.path.realpath(sysroot + d) # not join since d starts with '/'
@@ -402,19 +806,37 @@ if __name__ == "__main__":
                 if path not in lib_search_paths:
                     lib_search_paths.append(path)
 
+    paths = list(args.binaries)
+    for d in args.scan:
+        directory = sysroot + d
+        if not os.path.isdir(directory):
+            print("ERROR: {} is not a directory".format(directory))
+            ret = 1
+            continue
+        for path in find_elf_files(directory):
+            paths.append(path[len(sysroot):])
+
+    if args.jobs != 1:
+        prefetch_elf_info((sysroot + path for path in paths),
+                          args.jobs or None)
+
     bins = []
-    for path in args.binaries:
+    errors = []
+    for path in paths:
         try:
             b = Binary.try_binary(sysroot + path)
             bins.append(b)
         except FileNotFoundError as ex:
             print("ERROR: could not find '{}' sysroot={}".format(path, sysroot))
+            errors.append({"path": path, "error": "not found"})
             ret = 1
         except ELFError as ex:
             print("ERROR: not an ELF binary '{}': {}".format(path, ex))
+            errors.append({"path": path, "error": str(ex)})
             ret = 1
         except Exception as ex:
             print("ERROR: could not process '{}': {}".format(path, ex))
+            errors.append({"path": path, "error": str(ex)})
             ret = 1
 
     if args.all:
@@ -422,12 +844,23 @@ if __name__ == "__main__":
         bins.sort(key=lambda x: x.realpath)
 
 
-    last = len(bins) - 1
-    for i, b in enumerate(bins):
-        if args.reverse:
-            show_deps_reverse(b, "", i == last, tuple())
-        else:
-            show_deps(b, "", i == last, tuple())
-        print()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(image_report(bins, errors), f, indent=2)
+    else:
+        last = len(bins) - 1
+        for i, b in enumerate(bins):
+            if args.reverse:
+                show_deps_reverse(b, "", i == last, tuple())
+            else:
+                show_deps(b, "", i == last, tuple())
+            print()
+
+    if elf_cache is not None:
+        try:
+            elf_cache.save()
+        except OSError as ex:
+            print("WARNING: could not save cache {}: {}".format(
+                elf_cache.path, ex))
 
     exit(ret)
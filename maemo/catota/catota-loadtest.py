@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+"""Load generator for catota-server.
+
+Opens N concurrent /stream.do clients using the "synthetic" transcoder
+(so no mencoder is needed) plus M keep-alive /status.do pollers and
+reports aggregate throughput, per-client stalls, connect time and
+server CPU usage.
+"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import httplib
+import threading
+import subprocess
+import optparse
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+
+def proc_cpu_time(pid):
+    """User + system CPU time of process and its waited children."""
+    try:
+        f = open("/proc/%d/stat" % pid)
+        try:
+            stat = f.read()
+        finally:
+            f.close()
+    except IOError, e:
+        return None
+
+    fields = stat[stat.rfind(")") + 2:].split()
+    ticks = sum([int(x) for x in fields[11:15]])
+    return float(ticks) / os.sysconf("SC_CLK_TCK")
+# proc_cpu_time()
+
+
+
+class StreamClient(threading.Thread):
+    stall_threshold = 0.5 # read gaps longer than this are stalls
+    bufsize = 16384
+
+    def __init__(self, addr, url, duration):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.addr = addr
+        self.url = url
+        self.duration = duration
+        self.connect_time = None
+        self.ttfb = None
+        self.bytes = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.elapsed = 0.0
+        self.error = None
+    # __init__()
+
+
+    def run(self):
+        try:
+            self._run()
+        except Exception, e:
+            self.error = str(e)
+    # run()
+
+
+    def _run(self):
+        t0 = time.time()
+        skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        skt.connect(self.addr)
+        # completed by the kernel backlog, before server accept(); ttfb
+        # is what measures the server
+        self.connect_time = time.time() - t0
+        try:
+            skt.sendall("GET %s HTTP/1.0\r\n\r\n" % self.url)
+
+            last = t0
+            end = t0 + self.duration
+            while True:
+                d = skt.recv(self.bufsize)
+                now = time.time()
+                if not d:
+                    break
+                if self.ttfb is None:
+                    self.ttfb = now - t0
+                elif now - last > self.stall_threshold:
+                    self.stalls += 1
+                    self.stall_time += now - last
+                last = now
+                self.bytes += len(d)
+                if now >= end:
+                    break
+            self.elapsed = time.time() - t0
+        finally:
+            skt.close()
+    # _run()
+
+
+    def get_report(self):
+        return {"connect_time": self.connect_time,
+                "ttfb": self.ttfb,
+                "bytes": self.bytes,
+                "elapsed": self.elapsed,
+                "stalls": self.stalls,
+                "stall_time": self.stall_time,
+                "error": self.error}
+    # get_report()
+# StreamClient
+
+
+
+class StatusClient(threading.Thread):
+    def __init__(self, addr, duration, interval):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.addr = addr
+        self.duration = duration
+        self.interval = interval
+        self.latencies = []
+        self.errors = 0
+    # __init__()
+
+
+    def run(self):
+        conn = httplib.HTTPConnection(*self.addr)
+        end = time.time() + self.duration
+        while time.time() < end:
+            t0 = time.time()
+            try:
+                conn.request("GET", "/status.do")
+                conn.getresponse().read()
+                self.latencies.append(time.time() - t0)
+            except Exception, e:
+                self.errors += 1
+                conn.close()
+                conn = httplib.HTTPConnection(*self.addr)
+            time.sleep(self.interval)
+        conn.close()
+    # run()
+# StatusClient
+
+
+
+def _stats(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    values.sort()
+    n = len(values)
+    return {"min": values[0],
+            "avg": sum(values) / n,
+            "p95": values[min(n - 1, int(n * 0.95))],
+            "max": values[-1]}
+# _stats()
+
+
+def wait_server(addr, timeout=10.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            skt.connect(addr)
+            skt.close()
+            return True
+        except socket.error, e:
+            time.sleep(0.1)
+    return False
+# wait_server()
+
+
+def run(options):
+    addr = (options.host, options.port)
+
+    server = None
+    server_pid = options.server_pid
+    if not server_pid:
+        cmd = [sys.executable, "catota-server.py", "-p", str(options.port)]
+        server = subprocess.Popen(cmd, close_fds=True)
+        server_pid = server.pid
+        if not wait_server(addr):
+            os.kill(server_pid, signal.SIGTERM)
+            raise SystemExit("Server did not start: %s" % " ".join(cmd))
+
+    url = ("/stream.do?transcoder=synthetic&type=synthetic&location=load"
+           "&vbitrate=%d&abitrate=0&duration=%d" %
+           (options.bitrate, options.duration + 5))
+
+    try:
+        cpu0 = proc_cpu_time(server_pid)
+        t0 = time.time()
+
+        streams = [StreamClient(addr, url, options.duration)
+                   for i in xrange(options.streams)]
+        pollers = [StatusClient(addr, options.duration, options.interval)
+                   for i in xrange(options.status)]
+        for c in streams + pollers:
+            c.start()
+        for c in streams + pollers:
+            c.join()
+
+        wall = time.time() - t0
+        cpu1 = proc_cpu_time(server_pid)
+    finally:
+        if server:
+            os.kill(server_pid, signal.SIGTERM)
+            server.wait()
+
+    clients = [c.get_report() for c in streams]
+    total = sum([c["bytes"] for c in clients])
+    status_latencies = []
+    status_errors = 0
+    for p in pollers:
+        status_latencies.extend(p.latencies)
+        status_errors += p.errors
+
+    server_cpu = None
+    if cpu0 is not None and cpu1 is not None:
+        server_cpu = (cpu1 - cpu0) / wall
+
+    return {
+        "streams": options.streams,
+        "status_pollers": options.status,
+        "bitrate_kbps": options.bitrate,
+        "duration": wall,
+        "throughput_kbps": total * 8 / 1000.0 / wall,
+        "expected_kbps": options.streams * options.bitrate,
+        "errors": len([c for c in clients if c["error"]]),
+        "connect_time": _stats([c["connect_time"] for c in clients]),
+        "ttfb": _stats([c["ttfb"] for c in clients]),
+        "stall_time": _stats([c["stall_time"] for c in clients]),
+        "status_latency": _stats(status_latencies),
+        "status_errors": status_errors,
+        "server_cpu": server_cpu,
+        "clients": clients,
+        }
+# run()
+
+
+def print_report(r):
+    print "streams: %d x %d kbps, status pollers: %d, duration: %0.1fs" % \
+          (r["streams"], r["bitrate_kbps"], r["status_pollers"],
+           r["duration"])
+    print "throughput: %0.1f kbps (expected %d kbps), errors: %d" % \
+          (r["throughput_kbps"], r["expected_kbps"], r["errors"])
+    for key in ("connect_time", "ttfb", "stall_time", "status_latency"):
+        s = r[key]
+        if s:
+            print "%-15s min=%0.4f avg=%0.4f p95=%0.4f max=%0.4f" % \
+                  (key + ":", s["min"], s["avg"], s["p95"], s["max"])
+    if r["server_cpu"] is not None:
+        print "server cpu: %0.1f%%" % (r["server_cpu"] * 100)
+# print_report()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--streams", type="int", default=10,
+                      help="concurrent stream clients [%default]")
+    parser.add_option("-s", "--status", type="int", default=2,
+                      help="concurrent status pollers [%default]")
+    parser.add_option("-d", "--duration", type="int", default=30,
+                      help="test duration in seconds [%default]")
+    parser.add_option("-b", "--bitrate", type="int", default=528,
+                      help="stream bitrate in kbps [%default]")
+    parser.add_option("-i", "--interval", type="float", default=1.0,
+                      help="status polling interval [%default]")
+    parser.add_option("-H", "--host", default="127.0.0.1",
+                      help="server address [%default]")
+    parser.add_option("-p", "--port", type="int", default=40100,
+                      help="server port [%default]")
+    parser.add_option("-P", "--server-pid", type="int", default=0,
+                      help="use running server with this pid instead of "
+                      "starting one")
+    parser.add_option("-j", "--json", default=None,
+                      help="write JSON report to file")
+    options, args = parser.parse_args()
+
+    r = run(options)
+    print_report(r)
+
+    if options.json:
+        if json is None:
+            raise SystemExit("No JSON support, install simplejson")
+        f = open(options.json, "w")
+        try:
+            json.dump(r, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+# main()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,31 @@
 #!/usr/bin/env python
 
-import sys
 import os
+import optparse
 import logging as log
-from catota.server import serve_forever, load_plugins_transcoders
+from catota.server import serve_forever, load_plugins_transcoders, \
+     start_indexer
 
-log_level = log.WARNING
-for p in sys.argv[1:]:
-    if p == "-v" or p == "--verbose":
-        log_level -= 10
+parser = optparse.OptionParser(usage="%prog [options]")
+parser.add_option("-v", "--verbose", action="count", default=0,
+                  help="more log messages, may be repeated")
+parser.add_option("-p", "--port", type="int", default=40000,
+                  help="port to serve HTTP on [%default]")
+parser.add_option("-m", "--media-dir", action="append", default=[],
+                  help="directory to index media from, may be repeated")
+options, args = parser.parse_args()
+if args:
+    parser.error("unexpected arguments: %s" % " ".join(args))
+if not 0 < options.port < 65536:
+    parser.error("invalid port: %d" % options.port)
 
-log.basicConfig(level=log_level,
+log.basicConfig(level=log.WARNING - 10 * options.verbose,
                 format=("### %(asctime)s %(name)-18s %(levelname)-8s "
                         "%(message)s"),
                 datefmt="%Y-%m-%d %H:%M:%S")
 
 pd = os.path.join("catota", "plugins", "server", "transcoders")
 load_plugins_transcoders(pd)
-serve_forever()
+if options.media_dir:
+    start_indexer(options.media_dir)
+serve_forever(port=options.port)
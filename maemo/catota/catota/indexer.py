@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+
+__author__ = "Gustavo Sverzut Barbieri"
+__author_email__ = "barbieri@gmail.com"
+__license__ = "GPL"
+__version__ = "0.2"
+
+import os
+import stat
+import time
+import signal
+import shutil
+import tempfile
+import threading
+import subprocess
+import cPickle as pickle
+import catota.utils
+import logging as log
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+__all__ = ("MediaIndexer",)
+
+mplayer_path = catota.utils.which("mplayer")
+
+def_extensions = (".avi", ".mpg", ".mpeg", ".mp4", ".m4v", ".mkv", ".ogm",
+                  ".ogg", ".wmv", ".asf", ".flv", ".mov", ".vob", ".ts",
+                  ".mp3", ".wma", ".wav", ".flac", ".m4a")
+
+_identify_keys = {
+    "ID_LENGTH": ("length", float),
+    "ID_VIDEO_FORMAT": ("video_format", str),
+    "ID_VIDEO_CODEC": ("video_codec", str),
+    "ID_VIDEO_BITRATE": ("video_bitrate", int),
+    "ID_VIDEO_WIDTH": ("video_width", int),
+    "ID_VIDEO_HEIGHT": ("video_height", int),
+    "ID_AUDIO_FORMAT": ("audio_format", str),
+    "ID_AUDIO_CODEC": ("audio_codec", str),
+    "ID_AUDIO_BITRATE": ("audio_bitrate", int),
+    "ID_DEMUXER": ("demuxer", str),
+    }
+
+
+def thumbnail_name(path):
+    return md5(path).hexdigest() + ".jpg"
+# thumbnail_name()
+
+
+def _parse_identify(out):
+    info = {}
+    for line in out.splitlines():
+        try:
+            key, value = line.split("=", 1)
+        except ValueError, e:
+            continue
+        if key not in _identify_keys:
+            continue
+        name, conv = _identify_keys[key]
+        try:
+            info[name] = conv(value)
+        except ValueError, e:
+            pass
+    return info
+# _parse_identify()
+
+
+class _Probe(object):
+    """Extract media information and thumbnail of a single file.
+
+    Runs mplayer -identify and then, for videos, mplayer again to take
+    a thumbnail, without blocking: start() and then poll() until it
+    returns True, then info is set. Output goes to a temporary file, so
+    no pipe has to be read while waiting.
+
+    If mplayer could not be run (not a problem with the file), info is
+    None and the file should be probed again later.
+    """
+    log = log.getLogger("catota.indexer")
+
+    def __init__(self, path, thumb_dir, size):
+        self.path = path
+        self.thumb_dir = thumb_dir
+        self.size = size
+        self.info = None
+        self.proc = None
+        self.out = None
+        self.tmpdir = None
+        self._identified = None
+    # __init__()
+
+
+    def _spawn(self, args):
+        devnull = open(os.devnull, "r+")
+        try:
+            self.proc = subprocess.Popen(args, stdout=self.out or devnull,
+                                         stderr=devnull, stdin=devnull,
+                                         close_fds=True)
+        finally:
+            devnull.close()
+    # _spawn()
+
+
+    def start(self):
+        self.out = tempfile.TemporaryFile(prefix="catota-identify-")
+        try:
+            self._spawn([mplayer_path, "-identify", "-really-quiet",
+                         "-nolirc", "-frames", "0", "-vo", "null",
+                         "-ao", "null", self.path])
+        except OSError, e:
+            self.log.error("Could not run %s: %s" % (mplayer_path, e))
+            self.cleanup()
+            return False
+        return True
+    # start()
+
+
+    def _start_thumbnail(self, length):
+        self.tmpdir = tempfile.mkdtemp(prefix="catota-thumb-")
+        pos = 0
+        if length:
+            pos = int(length / 10)
+        self._spawn([mplayer_path, "-really-quiet", "-nolirc", "-nosound",
+                     "-ss", str(pos), "-frames", "2",
+                     "-vf", "scale=%d:-3" % self.size,
+                     "-vo", "jpeg:outdir=%s" % self.tmpdir, self.path])
+    # _start_thumbnail()
+
+
+    def _finish_thumbnail(self):
+        files = os.listdir(self.tmpdir)
+        if not files:
+            return None
+        files.sort()
+
+        name = thumbnail_name(self.path)
+        shutil.move(os.path.join(self.tmpdir, files[-1]),
+                    os.path.join(self.thumb_dir, name))
+        return name
+    # _finish_thumbnail()
+
+
+    def poll(self):
+        if self.proc is None:
+            return True
+        if self.proc.poll() is None:
+            return False
+        self.proc = None
+
+        try:
+            if self.tmpdir is None:
+                self.out.seek(0)
+                info = _parse_identify(self.out.read())
+                self.out.close()
+                self.out = None
+                if "video_format" in info or "video_codec" in info:
+                    self._identified = info
+                    self._start_thumbnail(info.get("length"))
+                    return False
+            else:
+                info = self._identified
+                info["thumbnail"] = self._finish_thumbnail()
+            self.info = info
+        except (OSError, IOError), e:
+            self.log.error("Failed to probe %s: %s" % (self.path, e))
+        self.cleanup()
+        return True
+    # poll()
+
+
+    def cleanup(self):
+        if self.proc is not None:
+            try:
+                os.kill(self.proc.pid, signal.SIGTERM)
+                self.proc.wait()
+            except OSError, e:
+                pass
+            self.proc = None
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, True)
+            self.tmpdir = None
+    # cleanup()
+# _Probe
+
+
+
+class MediaIndexer(object):
+    """Scans directories for media files and keeps an on-disk index.
+
+    Files are probed running up to 'processes' mplayer at once, only
+    new or changed (size, mtime) files are probed again. Entries are kept in
+    a dict that is replaced as a whole after each scan, so readers can
+    use it without locking.
+    """
+    log = log.getLogger("catota.indexer")
+    interval = 300 # seconds between scans
+    thumbnail_size = 160
+    poll_interval = 0.05
+    extensions = def_extensions
+
+    def __init__(self, directories, data_dir=None, processes=None):
+        self.directories = [os.path.abspath(d) for d in directories]
+        if data_dir is None:
+            data_dir = os.path.join(os.path.expanduser("~"), ".catota")
+        self.data_dir = data_dir
+        self.index_file = os.path.join(data_dir, "index")
+        self.thumb_dir = os.path.join(data_dir, "thumbnails")
+        if processes is None:
+            try:
+                processes = os.sysconf("SC_NPROCESSORS_ONLN")
+            except (AttributeError, ValueError, OSError), e:
+                processes = 1
+        self.processes = max(1, processes)
+        self._mplayer_missing_logged = False
+        self.entries = {}
+        self.run = False
+        self._thread = None
+        self._event = threading.Event()
+
+        if not os.path.isdir(self.thumb_dir):
+            os.makedirs(self.thumb_dir)
+        self.load()
+    # __init__()
+
+
+    def load(self):
+        try:
+            f = open(self.index_file, "rb")
+        except IOError, e:
+            return
+        try:
+            try:
+                self.entries = pickle.load(f)
+            except Exception, e:
+                self.log.warning("Ignored invalid index %s: %s" %
+                                 (self.index_file, e))
+        finally:
+            f.close()
+    # load()
+
+
+    def save(self):
+        tmp = self.index_file + ".tmp"
+        f = open(tmp, "wb")
+        try:
+            pickle.dump(self.entries, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, self.index_file)
+    # save()
+
+
+    def _walk(self):
+        exts = self.extensions
+        for directory in self.directories:
+            for root, dirs, files in os.walk(directory):
+                dirs.sort()
+                for name in files:
+                    if os.path.splitext(name)[1].lower() not in exts:
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError, e:
+                        continue
+                    if stat.S_ISREG(st.st_mode):
+                        yield path, st.st_size, int(st.st_mtime)
+    # _walk()
+
+
+    def _probe_all(self, paths):
+        """Probe paths running at most self.processes mplayer at once.
+
+        This is done from the indexer thread with plain subprocesses,
+        forking the (threaded) server process just to exec mplayer.
+        Returns list of (path, info), info is None if mplayer could not
+        be run.
+        """
+        todo = list(paths)
+        todo.reverse()
+        running = []
+        results = []
+        try:
+            while todo or running:
+                while todo and len(running) < self.processes:
+                    p = _Probe(todo.pop(), self.thumb_dir,
+                               self.thumbnail_size)
+                    if p.start():
+                        running.append(p)
+                    else:
+                        results.append((p.path, None))
+
+                time.sleep(self.poll_interval)
+                still_running = []
+                for p in running:
+                    if p.poll():
+                        results.append((p.path, p.info))
+                    else:
+                        still_running.append(p)
+                running = still_running
+
+                if not self.run:
+                    break
+        finally:
+            for p in running:
+                p.cleanup()
+        return results
+    # _probe_all()
+
+
+    def scan(self):
+        global mplayer_path
+        if not mplayer_path:
+            mplayer_path = catota.utils.which("mplayer")
+            if not mplayer_path:
+                if not self._mplayer_missing_logged:
+                    self.log.error("mplayer not found, media not indexed")
+                    self._mplayer_missing_logged = True
+                return
+        self._mplayer_missing_logged = False
+
+        old = self.entries
+        entries = {}
+        todo = []
+        for path, size, mtime in self._walk():
+            e = old.get(path)
+            # "error" entries are from older versions, probe them again
+            if e and e["size"] == size and e["mtime"] == mtime and \
+               "error" not in e:
+                entries[path] = e
+            else:
+                entries[path] = {"size": size, "mtime": mtime}
+                todo.append(path)
+
+        if todo:
+            self.log.info("Probing %d of %d files" % (len(todo), len(entries)))
+            t0 = time.time()
+            probed = dict(self._probe_all(todo))
+            for path in todo:
+                info = probed.get(path)
+                if info is not None:
+                    entries[path].update(info)
+                elif path in old:
+                    # not probed (mplayer failed or stopped), keep the
+                    # old entry, it does not match so it is tried again
+                    entries[path] = old[path]
+                else:
+                    del entries[path]
+            self.log.info("Probed %d files in %0.1fs" %
+                          (len(todo), time.time() - t0))
+
+        for path, entry in old.iteritems():
+            if path not in entries and entry.get("thumbnail"):
+                try:
+                    os.unlink(os.path.join(self.thumb_dir,
+                                           entry["thumbnail"]))
+                except OSError, e:
+                    pass
+
+        self.entries = entries
+        if todo or len(entries) != len(old):
+            self.save()
+    # scan()
+
+
+    def get_entries(self, prefix=None):
+        entries = self.entries
+        paths = entries.keys()
+        paths.sort()
+        lst = []
+        for path in paths:
+            if prefix and not path.startswith(prefix):
+                continue
+            d = dict(entries[path])
+            # os.walk() gives byte strings, that may not be UTF-8
+            d["location"] = path.decode("utf-8", "replace")
+            lst.append(d)
+        return lst
+    # get_entries()
+
+
+    def get_thumbnail_path(self, location):
+        e = self.entries.get(location)
+        if not e or not e.get("thumbnail"):
+            return None
+        return os.path.join(self.thumb_dir, e["thumbnail"])
+    # get_thumbnail_path()
+
+
+    def _loop(self):
+        while self.run:
+            try:
+                self.scan()
+            except Exception, e:
+                self.log.error("Failed to scan media: %s" % e)
+            self._event.wait(self.interval)
+    # _loop()
+
+
+    def start(self):
+        if self._thread:
+            return
+        self.run = True
+        self._event.clear()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.setDaemon(True)
+        self._thread.start()
+    # start()
+
+
+    def stop(self):
+        self.run = False
+        self._event.set()
+        self._thread = None
+    # stop()
+# MediaIndexer
@@ -12,11 +12,33 @@ class TranscoderMencoder(catota.server.Transcoder):
                                         "mencoder-fifo-%(uid)s-%(pid)s")
     name = "mencoder"
     priority = -1
+    # (vbitrate, width, height) steps used with "adaptive=1"
+    def_ladder = ((800, 640, 480),
+                  (600, 480, 360),
+                  (400, 320, 240),
+                  (250, 320, 240),
+                  (150, 240, 180),
+                  (80, 160, 120))
+    seekable_types = ("file", "dvd", "vcd")
+    # switching restarts mencoder, it must resume where it was: seek on
+    # seekable types or just continue live ones
+    live_types = ("tv", "dvb", "radio")
+    # switching restarts mencoder and appends a new stream to the
+    # response, only muxes that can be concatenated allow "adaptive=1"
+    concatenable_muxes = ("mpeg",)
+    try:
+        clock_ticks = os.sysconf("SC_CLK_TCK")
+    except (AttributeError, ValueError, OSError), e:
+        clock_ticks = 100
 
     def __init__(self, params):
         catota.server.Transcoder.__init__(self, params)
         self.proc = None
         self.args = None
+        self.step = 0
+        self.stopped = False
+        self.cpu_time_done = 0.0 # of processes killed by _kill()
+        self.cpu_time_last = 0.0 # last get_cpu_time()
 
         vars = {"uid": os.getuid(), "pid": os.getpid()}
         mencoder_outfile_base = self.def_mencoder_outfile % vars
@@ -29,6 +51,46 @@ class TranscoderMencoder(catota.server.Transcoder):
         self.mencoder_outfile = mencoder_outfile
         os.mkfifo(self.mencoder_outfile)
 
+        params_first = self.params_first
+        self.seekable = params_first("type") in self.seekable_types
+
+        vbitrate = int(params_first("vbitrate", "400"))
+        width = int(params_first("width", "320"))
+        height = int(params_first("height", "240"))
+        self.ladder = [(vbitrate, width, height)]
+
+        self.adapter = None
+        adaptive = params_first("adaptive", "0") not in ("0", "no", "false")
+        mux = params_first("mux", "avi")
+        if adaptive and mux not in self.concatenable_muxes:
+            self.log.warning("Ignored adaptive=1, mux %s cannot be "
+                             "concatenated, use one of: %s" %
+                             (mux, ", ".join(self.concatenable_muxes)))
+            adaptive = False
+
+        type = params_first("type")
+        if adaptive and not (self.seekable or type in self.live_types):
+            self.log.warning("Ignored adaptive=1, type %s cannot be "
+                             "resumed, use one of: %s" %
+                             (type, ", ".join(self.seekable_types +
+                                              self.live_types)))
+            adaptive = False
+
+        if adaptive:
+            for step in self.def_ladder:
+                if step[0] < vbitrate:
+                    self.ladder.append(step)
+
+            abitrate = int(params_first("abitrate", "128"))
+            rates = [v + abitrate for v, w, h in self.ladder]
+            self.adapter = catota.server.RateAdapter(self.stats, rates)
+
+        self.position = 0.0
+        self.args = self._build_args(0)
+    # __init__()
+
+
+    def _build_args(self, step, position=0.0):
         args = [self.mencoder_path, "-really-quiet",
                 "-o", self.mencoder_outfile]
 
@@ -38,6 +100,9 @@ class TranscoderMencoder(catota.server.Transcoder):
         location = params_first("location")
         args.append("%s://%s" % (type, location))
 
+        if position > 0 and self.seekable:
+            args.extend(["-ss", "%0.1f" % position])
+
         mux = params_first("mux", "avi")
         args.extend(["-of", mux])
 
@@ -50,20 +115,24 @@ class TranscoderMencoder(catota.server.Transcoder):
             args.extend(["-oac", "lavc", "-lavcopts",
                          "acodec=%s:abitrate=%s" % (acodec, abitrate)])
 
+        vbitrate, width, height = self.ladder[step]
+
         vcodec = params_first("vcodec", "mpeg4")
-        vbitrate = params_first("vbitrate", "400")
         args.extend(["-ovc", "lavc", "-lavcopts",
                      "vcodec=%s:vbitrate=%s" % (vcodec, vbitrate)])
 
         fps = params_first("fps", "24")
         args.extend(["-ofps", fps])
 
-        width = params_first("width", "320")
-        height = params_first("height", "240")
         args.extend(["-vf", "scale=%s:%s" % (width, height)])
+        return args
+    # _build_args()
 
-        self.args = args
-    # __init__()
+
+    def _kbps(self, step):
+        abitrate = int(self.params_first("abitrate", "128"))
+        return self.ladder[step][0] + abitrate
+    # _kbps()
 
 
     def _unlink_fifo(self):
@@ -74,7 +143,7 @@ class TranscoderMencoder(catota.server.Transcoder):
     # _unlink_fifo()
 
 
-    def start(self, outfd):
+    def _spawn(self):
         cmd = " ".join(self.args)
         self.log.info("Mencoder: %s" % cmd)
 
@@ -82,18 +151,81 @@ class TranscoderMencoder(catota.server.Transcoder):
             self.proc = subprocess.Popen(self.args, close_fds=True)
         except Exception, e:
             self.log.error("Error executing mencoder: %s" % cmd)
-            return False
+            return None
 
         try:
-            fifo_read = open(self.mencoder_outfile)
+            return open(self.mencoder_outfile)
         except Exception, e:
             self.log.error("Error opening fifo: %s" % cmd)
+            return None
+    # _spawn()
+
+
+    def _kill(self):
+        """Terminate mencoder, adding its CPU time to cpu_time_done."""
+        proc = self.proc
+        if not proc:
+            return
+        self.proc = None
+
+        # last sample, in case it was already waited and is gone
+        cpu_time = self._proc_cpu_time(proc)
+        try:
+            os.kill(proc.pid, signal.SIGTERM)
+        except OSError, e:
+            pass
+
+        if proc.returncode is None:
+            try:
+                pid, status, rusage = os.wait4(proc.pid, 0)
+                cpu_time = rusage.ru_utime + rusage.ru_stime
+                if os.WIFSIGNALED(status):
+                    proc.returncode = -os.WTERMSIG(status)
+                else:
+                    proc.returncode = os.WEXITSTATUS(status)
+            except OSError, e:
+                pass
+
+        self.cpu_time_done += cpu_time
+    # _kill()
+
+
+    def _switch(self, fifo_read, step, nbytes):
+        """Restart mencoder at the given ladder step, continuing from the
+        estimated position of what was already sent.
+        """
+        self.position += nbytes * 8 / (self._kbps(self.step) * 1000.0)
+        self.step = step
+        self.args = self._build_args(step, self.position)
+
+        self._kill()
+        fifo_read.close()
+        if self.stopped:
+            return None
+        return self._spawn()
+    # _switch()
+
+
+    def start(self, outfd):
+        fifo_read = self._spawn()
+        if not fifo_read:
             return False
 
+        adapter = self.adapter
+        nbytes = 0
         try:
             while self.proc and self.proc.poll() == None:
                 d = fifo_read.read(1024)
                 outfd.write(d)
+                nbytes += len(d)
+
+                if adapter:
+                    step = adapter.check()
+                    if step is not None:
+                        fifo_read = self._switch(fifo_read, step, nbytes)
+                        nbytes = 0
+                        if not fifo_read:
+                            break
         except Exception, e:
             self.log.error("Problems handling data: %s" % e)
             self._unlink_fifo()
@@ -104,19 +236,39 @@ class TranscoderMencoder(catota.server.Transcoder):
     # start()
 
 
-    def stop(self):
-        if self.proc:
+    def _proc_cpu_time(self, proc):
+        try:
+            f = open("/proc/%d/stat" % proc.pid)
             try:
-                os.kill(self.proc.pid, signal.SIGTERM)
-            except OSError, e:
-                pass
+                stat = f.read()
+            finally:
+                f.close()
+        except IOError, e:
+            return 0.0
+
+        # skip "pid (comm)", comm may contain spaces
+        fields = stat[stat.rfind(")") + 2:].split()
+        utime, stime = int(fields[11]), int(fields[12])
+        return float(utime + stime) / self.clock_ticks
+    # _proc_cpu_time()
+
+
+    def get_cpu_time(self):
+        """CPU time of all mencoder processes, including those replaced
+        by ladder switches, so it never goes down.
+        """
+        cpu_time = self.cpu_time_done
+        if self.proc:
+            cpu_time += self._proc_cpu_time(self.proc)
+        # an exited, already waited, process is gone from /proc
+        self.cpu_time_last = max(self.cpu_time_last, cpu_time)
+        return self.cpu_time_last
+    # get_cpu_time()
 
-            try:
-                self.proc.wait()
-            except Exception, e:
-                pass
 
-            self.proc = None
+    def stop(self):
+        self.stopped = True
+        self._kill()
 
         self._unlink_fifo()
     # stop()
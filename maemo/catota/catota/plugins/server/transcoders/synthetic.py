@@ -0,0 +1,61 @@
+import catota.server
+import time
+
+__all__ = ("TranscoderSynthetic",)
+
+class TranscoderSynthetic(catota.server.Transcoder):
+    """Emits zeros at the requested bitrate, used for load testing.
+
+    Parameters: vbitrate + abitrate (kbps, default 400 + 128),
+    chunk (bytes per write, default 4096) and duration (seconds,
+    default until stopped or client goes away).
+    """
+    name = "synthetic"
+    priority = 100
+
+    def __init__(self, params):
+        catota.server.Transcoder.__init__(self, params)
+        params_first = self.params_first
+        kbps = int(params_first("vbitrate", "400")) + \
+               int(params_first("abitrate", "128"))
+        self.rate = kbps * 1000 / 8.0
+        self.chunk = int(params_first("chunk", "4096"))
+        self.duration = float(params_first("duration", "0"))
+        self.running = False
+    # __init__()
+
+
+    def get_mimetype(self):
+        return "application/octet-stream"
+    # get_mimetype()
+
+
+    def start(self, outfd):
+        self.running = True
+        data = "\0" * self.chunk
+        t0 = time.time()
+        sent = 0
+        try:
+            while self.running:
+                now = time.time()
+                if self.duration and now - t0 >= self.duration:
+                    break
+
+                ahead = sent / self.rate - (now - t0)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+                outfd.write(data)
+                sent += len(data)
+        except Exception, e:
+            self.log.info("Synthetic stream finished: %s" % e)
+            return False
+        return True
+    # start()
+
+
+    def stop(self):
+        self.running = False
+        return True
+    # stop()
+# TranscoderSynthetic
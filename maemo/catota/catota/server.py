@@ -6,6 +6,8 @@ __license__ = "GPL"
 __version__ = "0.2"
 
 import os
+import time
+import select
 import threading
 import SocketServer
 import BaseHTTPServer
@@ -13,10 +15,228 @@ import socket
 import urlparse
 import cgi
 import catota.utils
+import catota.indexer
 import logging as log
 
-__all__ = ("Transcoder", "RequestHandler", "Server", "serve_forever",
-           "load_plugins_transcoders")
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+__all__ = ("Transcoder", "StreamStats", "MeteredWriter", "ChunkedWriter",
+           "RateAdapter", "RequestHandler", "Server", "serve_forever",
+           "load_plugins_transcoders", "start_indexer")
+
+
+class StreamStats(object):
+    """Counters about data sent to one client.
+
+    Only the stream thread writes to these attributes, readers just
+    peek at them without any locking, so values may be slightly stale.
+    """
+    rate_window = 2.0 # seconds used to compute current throughput
+
+    def __init__(self):
+        self.started = time.time()
+        self.first_byte = None
+        self.bytes = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.rate = 0.0
+        self._win_start = self.started
+        self._win_bytes = 0
+    # __init__()
+
+
+    def update(self, nbytes, now, stalled, wait):
+        if self.first_byte is None:
+            self.first_byte = now
+        self.bytes += nbytes
+        if stalled:
+            self.stalls += 1
+            self.stall_time += wait
+
+        elapsed = now - self._win_start
+        if elapsed >= self.rate_window:
+            self.rate = (self.bytes - self._win_bytes) / elapsed
+            self._win_start = now
+            self._win_bytes = self.bytes
+    # update()
+
+
+    def get_rate(self, now=None):
+        if now is None:
+            now = time.time()
+        elapsed = now - self._win_start
+        if elapsed >= self.rate_window or (not self.rate and elapsed > 0):
+            # first window or nothing sent for a while, use partial window
+            return (self.bytes - self._win_bytes) / elapsed
+        return self.rate
+    # get_rate()
+
+
+    def get_ttfb(self):
+        if self.first_byte is None:
+            return None
+        return self.first_byte - self.started
+    # get_ttfb()
+# StreamStats
+
+
+
+class MeteredWriter(object):
+    """Wraps output file and account written data in a StreamStats.
+
+    A write is accounted as a stall if socket send buffer is full when
+    it's called, that is, the client is not draining data fast enough.
+    """
+    def __init__(self, outfile, stats):
+        self.outfile = outfile
+        self.stats = stats
+        try:
+            self.fd = outfile.fileno()
+        except Exception, e:
+            self.fd = None
+    # __init__()
+
+
+    def _is_writable(self):
+        if self.fd is None:
+            return True
+        try:
+            r, w, x = select.select((), (self.fd,), (), 0)
+        except Exception, e:
+            return True
+        return bool(w)
+    # _is_writable()
+
+
+    def write(self, data):
+        stalled = not self._is_writable()
+        t0 = time.time()
+        self.outfile.write(data)
+        now = time.time()
+        self.stats.update(len(data), now, stalled, now - t0)
+    # write()
+
+
+    def flush(self):
+        self.outfile.flush()
+    # flush()
+
+
+    def fileno(self):
+        return self.fd
+    # fileno()
+# MeteredWriter
+
+
+
+class RateAdapter(object):
+    """Choose a bitrate ladder step based on client drain rate.
+
+    ladder is a sequence of total bitrates (kbps), from highest to
+    lowest quality. check() should be called often from the stream
+    thread, it returns the new step index when a switch is needed or
+    None to keep the current one.
+
+    Client is falling behind if it drains less than down_ratio of the
+    current bitrate, there is headroom if it drains at least up_ratio
+    of it and the send buffer was almost never full.
+    """
+    log = log.getLogger("catota.rateadapter")
+    check_interval = 5.0
+    hold_time = 15.0 # minimum time between switches
+    down_ratio = 0.85
+    up_ratio = 1.0
+    up_max_stall = 0.05 # fraction of time stalled
+
+    def __init__(self, stats, ladder, step=0):
+        self.stats = stats
+        self.ladder = ladder
+        self.step = step
+        self.last_switch = time.time()
+        self._reset(self.last_switch)
+    # __init__()
+
+
+    def _reset(self, now):
+        self._last_check = now
+        self._last_bytes = self.stats.bytes
+        self._last_stall_time = self.stats.stall_time
+    # _reset()
+
+
+    def check(self, now=None):
+        if now is None:
+            now = time.time()
+        dt = now - self._last_check
+        if dt < self.check_interval:
+            return None
+
+        drain = (self.stats.bytes - self._last_bytes) / dt
+        stall = (self.stats.stall_time - self._last_stall_time) / dt
+        self._reset(now)
+
+        if now - self.last_switch < self.hold_time:
+            return None
+
+        needed = self.ladder[self.step] * 1000 / 8.0
+        step = self.step
+        if drain < needed * self.down_ratio:
+            if step + 1 < len(self.ladder):
+                step += 1
+        elif drain >= needed * self.up_ratio and stall <= self.up_max_stall:
+            if step > 0:
+                step -= 1
+
+        if step == self.step:
+            return None
+
+        self.log.info("switch step %d -> %d: drain=%0.1fkbps, "
+                      "bitrate=%skbps, stall=%0.2f" %
+                      (self.step, step, drain * 8 / 1000.0,
+                       self.ladder[self.step], stall))
+        self.step = step
+        self.last_switch = now
+        return step
+    # check()
+# RateAdapter
+
+
+
+class ChunkedWriter(object):
+    """Writes data using HTTP/1.1 chunked transfer encoding."""
+    def __init__(self, outfile):
+        self.outfile = outfile
+    # __init__()
+
+
+    def write(self, data):
+        if data:
+            self.outfile.write("%x\r\n%s\r\n" % (len(data), data))
+    # write()
+
+
+    def flush(self):
+        self.outfile.flush()
+    # flush()
+
+
+    def close(self):
+        self.outfile.write("0\r\n\r\n")
+    # close()
+
+
+    def fileno(self):
+        return self.outfile.fileno()
+    # fileno()
+# ChunkedWriter
+
+
 
 class Transcoder(object):
     log = log.getLogger("catota.transcoder")
@@ -25,6 +245,7 @@ class Transcoder(object):
 
     def __init__(self, params):
         self.params = params
+        self.stats = StreamStats()
     # __init__()
 
 
@@ -61,6 +282,12 @@ class Transcoder(object):
     # stop()
 
 
+    def get_cpu_time(self):
+        """CPU time (user + system, in seconds) used to transcode."""
+        return 0.0
+    # get_cpu_time()
+
+
     def __str__(self):
         return '%s("%s://%s", mux="%s", params=%s)' % \
                (self.__class__.__name__,
@@ -75,7 +302,9 @@ class Transcoder(object):
 
 class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     log = log.getLogger("catota.request")
+    timeout = 30 # close idle keep-alive connections
     def_transcoder = None
+    indexer = None
     transcoders = catota.utils.PluginSet(Transcoder)
 
     @classmethod
@@ -106,6 +335,12 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             self.serve_play(body)
         elif self.path == "/stream.do":
             self.serve_stream(body)
+        elif self.path == "/metrics":
+            self.serve_metrics(body)
+        elif self.path == "/index.do":
+            self.serve_index(body)
+        elif self.path == "/thumbnail.do":
+            self.serve_thumbnail(body)
         else:
             self.send_error(404, "File not found")
     # do_dispatch()
@@ -122,44 +357,55 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
 
     def _nav_items(self):
-        self.wfile.write("""\
+        return """\
    <li><a href="/play.do">Play</a></li>
    <li><a href="/status.do">Status</a></li>
+   <li><a href="/metrics">Metrics</a></li>
+   <li><a href="/index.do">Media Index</a></li>
    <li><a href="/stop-transcoder.do">Stop transcoders</a></li>
    <li><a href="/shutdown.do">Shutdown Server</a></li>
-""")
+"""
     # _nav_items()
 
 
-    def serve_main(self, body):
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html")
-        self.send_header('Connection', 'close')
+    def _send_connection_header(self):
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        elif self.request_version == "HTTP/1.0":
+            self.send_header('Connection', 'keep-alive')
+    # _send_connection_header()
+
+
+    def send_page(self, body, data, mimetype="text/html", code=200):
+        """Send whole response with Content-Length, so connection may
+        be kept alive and reused by the client.
+        """
+        self.send_response(code)
+        self.send_header("Content-Type", mimetype)
+        self.send_header("Content-Length", str(len(data)))
+        self._send_connection_header()
         self.end_headers()
         if body:
-            self.wfile.write("""\
+            self.wfile.write(data)
+    # send_page()
+
+
+    def serve_main(self, body):
+        self.send_page(body, """\
 <html>
    <head><title>Catota Server</title></head>
    <body>
 <h1>Welcome to Catota Server</h1>
 <ul>
-""")
-            self._nav_items()
-            self.wfile.write("""\
-</ul>
+%s</ul>
    </body>
 </html>
-""")
+""" % self._nav_items())
     # serve_main()
 
 
     def serve_play(self, body):
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html")
-        self.send_header('Connection', 'close')
-        self.end_headers()
-        if body:
-            self.wfile.write("""\
+        self.send_page(body, """\
 <html>
    <head><title>Catota Server</title></head>
    <body>
@@ -169,23 +415,16 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       <input type="submit" />
    </form>
    <ul>
-""")
-            self._nav_items()
-            self.wfile.write("""\
-   </ul>
+%s   </ul>
    </body>
 </html>
-""")
+""" % self._nav_items())
     # serve_play()
 
 
     def serve_shutdown(self, body):
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html")
-        self.send_header('Connection', 'close')
-        self.end_headers()
-        if body:
-            self.wfile.write("""\
+        self.close_connection = 1
+        self.send_page(body, """\
 <html>
    <head><title>Catota Server Exited</title></head>
    <body>
@@ -198,47 +437,36 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
 
     def serve_stop_all_transcoders(self, body):
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html")
-        self.send_header('Connection', 'close')
-        self.end_headers()
         if body:
             self.server.stop_transcoders()
-            self.wfile.write("""\
+        self.send_page(body, """\
 <html>
    <head><title>Catota Server Stopped Transcoders</title></head>
    <body>
       <h1>Catota stopped running transcoders</h1>
       <ul>
-""")
-            self._nav_items()
-            self.wfile.write("""\
-      </ul>
+%s      </ul>
    </body>
 </html>
-    """)
+""" % self._nav_items())
     # serve_stop_all_transcoders()
 
 
     def serve_stop_selected_transcoders(self, body, requests):
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html")
-        self.send_header('Connection', 'close')
-        self.end_headers()
-        if body:
-            self.wfile.write("""\
+        out = ["""\
 <html>
    <head><title>Catota Server Stopped Transcoders</title></head>
    <body>
       <h1>Catota stopped running transcoders:</h1>
       <ul>
-    """)
+"""]
+        if body:
             transcoders = self.server.get_transcoders()
 
             for req in requests:
                 try:
                     host, port = req.split(":")
-                except IndexError:
+                except ValueError:
                     continue
 
                 port = int(port)
@@ -246,21 +474,19 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
                 for t, r in transcoders:
                     if r.client_address == addr:
-                        self.wfile.write("""\
+                        out.append("""\
          <li>%s: %s:%s</li>
 """ % (t, addr[0], addr[1]))
                         t.stop()
                         break
-            self.wfile.write("""\
+        out.append("""\
       </ul>
       <ul>
-""")
-            self._nav_items()
-            self.wfile.write("""\
-      </ul>
+%s      </ul>
    </body>
 </html>
-""")
+""" % self._nav_items())
+        self.send_page(body, "".join(out))
     # serve_stop_selected_transcoders()
 
 
@@ -276,45 +502,146 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
 
     def serve_status(self, body):
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html")
-        self.send_header('Connection', 'close')
-        self.end_headers()
-        if body:
-            self.wfile.write("""\
+        out = ["""\
 <html>
    <head><title>Catota Server Status</title></head>
    <body>
       <h1>Catota Status</h1>
-""")
-            tl = self.server.get_transcoders()
-            if not tl:
-                self.wfile.write("<p>No running transcoder.</p>\n")
-            else:
-                self.wfile.write("<p>Running transcoders:</p>\n")
-                self.wfile.write("""\
+"""]
+        tl = self.server.get_transcoders()
+        if not tl:
+            out.append("<p>No running transcoder.</p>\n")
+        else:
+            out.append("<p>Running transcoders:</p>\n")
+            out.append("""\
       <ul>
          <li><a href="/stop-transcoder.do?request=all">[STOP ALL]</a></li>
 """)
-                for transcoder, request in tl:
-                    self.wfile.write("""\
+            for transcoder, request in tl:
+                out.append("""\
       <li>%s: %s:%s <a href="/stop-transcoder.do?request=%s:%s">[STOP]</a></li>
 """ % (transcoder, request.client_address[0], request.client_address[1],
        request.client_address[0], request.client_address[1]))
 
-                self.wfile.write("""\
+            out.append("""\
       </ul>
       <ul>
 """)
-            self._nav_items()
-            self.wfile.write("""\
-      </ul>
+        out.append("""\
+%s      </ul>
    </body>
 </html>
-""")
+""" % self._nav_items())
+        self.send_page(body, "".join(out))
     # serve_status()
 
 
+    _metrics = (
+        ("bytes_total", "counter", "Bytes streamed to client.", "bytes"),
+        ("throughput_bytes_per_second", "gauge",
+         "Current throughput to client.", "rate"),
+        ("time_to_first_byte_seconds", "gauge",
+         "Time from request to first byte sent.", "ttfb"),
+        ("send_stalls_total", "counter",
+         "Writes done while client send buffer was full.", "stalls"),
+        ("send_stall_seconds_total", "counter",
+         "Time spent waiting for client to drain send buffer.",
+         "stall_time"),
+        ("cpu_seconds_total", "counter",
+         "CPU time used by the transcoder process.", "cpu_time"),
+        )
+
+    def _get_metrics(self):
+        now = time.time()
+        lst = []
+        for transcoder, request in self.server.get_transcoders():
+            stats = transcoder.stats
+            lst.append({
+                "transcoder": transcoder.name,
+                "client": "%s:%s" % request.client_address,
+                "type": transcoder.params_first("type", ""),
+                "location": transcoder.params_first("location", ""),
+                "uptime": now - stats.started,
+                "bytes": stats.bytes,
+                "rate": stats.get_rate(now),
+                "ttfb": stats.get_ttfb(),
+                "stalls": stats.stalls,
+                "stall_time": stats.stall_time,
+                "cpu_time": transcoder.get_cpu_time(),
+                })
+        return lst
+    # _get_metrics()
+
+
+    def _format_metrics_prometheus(self, lst):
+        out = ["# HELP catota_transcoders_active Running transcoders.",
+               "# TYPE catota_transcoders_active gauge",
+               "catota_transcoders_active %d" % len(lst)]
+        for name, type, help, key in self._metrics:
+            name = "catota_transcoder_" + name
+            out.append("# HELP %s %s" % (name, help))
+            out.append("# TYPE %s %s" % (name, type))
+            for m in lst:
+                value = m[key]
+                if value is None:
+                    continue
+                out.append('%s{transcoder="%s",client="%s"} %s' %
+                           (name, m["transcoder"], m["client"], value))
+        out.append("")
+        return "\n".join(out)
+    # _format_metrics_prometheus()
+
+
+    def serve_metrics(self, body):
+        fmt = self.query.get("format", ["prometheus"])[0]
+        if fmt == "json":
+            if json is None:
+                self.send_error(501, "No JSON support, install simplejson")
+                return
+            ctype = "application/json"
+            data = json.dumps({"transcoders": self._get_metrics()})
+        else:
+            ctype = "text/plain; version=0.0.4"
+            data = self._format_metrics_prometheus(self._get_metrics())
+
+        self.send_page(body, data, ctype)
+    # serve_metrics()
+
+
+    def serve_index(self, body):
+        if self.indexer is None:
+            self.send_error(404, "Media indexer is not enabled")
+            return
+        if json is None:
+            self.send_error(501, "No JSON support, install simplejson")
+            return
+
+        prefix = self.query.get("dir", [None])[0]
+        data = json.dumps({"entries": self.indexer.get_entries(prefix)})
+        self.send_page(body, data, "application/json")
+    # serve_index()
+
+
+    def serve_thumbnail(self, body):
+        path = None
+        if self.indexer is not None:
+            location = self.query.get("location", [None])[0]
+            path = self.indexer.get_thumbnail_path(location)
+
+        try:
+            f = open(path, "rb")
+        except (IOError, TypeError), e:
+            self.send_error(404, "No thumbnail")
+            return
+
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        self.send_page(body, data, "image/jpeg")
+    # serve_thumbnail()
+
+
     def _get_transcoder(self):
         request_transcoders = self.query.get("transcoder", ["mencoder"])
 
@@ -336,15 +663,39 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             self.send_error(500, str(e))
             return
 
+        chunked = self.request_version >= "HTTP/1.1"
+        if not chunked:
+            self.close_connection = 1
+
         self.send_response(200)
         self.send_header("Content-Type", obj.get_mimetype())
-        self.send_header('Connection', 'close')
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        self._send_connection_header()
         self.end_headers()
 
-        if body:
-            self.server.add_transcoders(self, obj)
-            obj.start(self.wfile)
+        if not body:
+            return
+
+        if chunked:
+            outfile = ChunkedWriter(self.wfile)
+        else:
+            outfile = self.wfile
+
+        # idle timeout is meant for keep-alive, not for slow clients
+        self.connection.settimeout(None)
+
+        self.server.add_transcoders(self, obj)
+        try:
+            try:
+                obj.start(MeteredWriter(outfile, obj.stats))
+                if chunked:
+                    outfile.close()
+            except socket.error, e:
+                self.close_connection = 1
+        finally:
             self.server.del_transcoders(self, obj)
+            self.connection.settimeout(self.timeout)
     # serve_stream()
 
 
@@ -366,9 +717,16 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
 
 class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server keeping track of running transcoders.
+
+    Writers (stream threads) serialize on _lock and publish a new
+    immutable _snapshot tuple, readers (status, metrics) just grab the
+    current snapshot reference and never block on the lock.
+    """
     log = log.getLogger("catota.server")
     run = True
     _transcoders = {}
+    _snapshot = ()
     _lock = threading.RLock()
 
     def serve_forever(self):
@@ -404,34 +762,37 @@ class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     def server_close(self):
         self.run = False
         self.stop_transcoders()
+        if RequestHandler.indexer:
+            RequestHandler.indexer.stop()
 
         BaseHTTPServer.HTTPServer.server_close(self)
     # server_close()
 
 
     def stop_transcoders(self):
-        self._lock.acquire()
-        for transcoder, request in self._transcoders.iteritems():
+        for transcoder, request in self.get_transcoders():
             self.log.info("Stop transcoder: %s, client=%s" %
                           (transcoder, request.client_address))
             transcoder.stop()
-        self._lock.release()
     # stop_transcoders()
 
 
     def get_transcoders(self):
-        self._lock.acquire()
-        try:
-            return self._transcoders.items()
-        finally:
-            self._lock.release()
+        return self._snapshot
     # get_transcoders()
 
 
+    def _publish(self):
+        # must be called with _lock held
+        Server._snapshot = tuple(self._transcoders.items())
+    # _publish()
+
+
     def add_transcoders(self, request, transcoder):
         self._lock.acquire()
         try:
             self._transcoders[transcoder] = request
+            self._publish()
         finally:
             self._lock.release()
     # add_transcoders()
@@ -441,6 +802,7 @@ class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
         self._lock.acquire()
         try:
             del self._transcoders[transcoder]
+            self._publish()
         finally:
             self._lock.release()
     # del_transcoders()
@@ -451,7 +813,7 @@ class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
 def serve_forever(host="0.0.0.0", port=40000):
     addr = (host, port)
 
-    RequestHandler.protocol_version = "HTTP/1.0"
+    RequestHandler.protocol_version = "HTTP/1.1"
     httpd = Server(addr, RequestHandler)
     httpd.serve_forever()
 # serve_forever()
@@ -460,3 +822,11 @@ def serve_forever(host="0.0.0.0", port=40000):
 def load_plugins_transcoders(directory):
     RequestHandler.load_plugins_transcoders(directory)
 # load_plugins_transcoders()
+
+
+def start_indexer(directories, data_dir=None):
+    indexer = catota.indexer.MediaIndexer(directories, data_dir)
+    RequestHandler.indexer = indexer
+    indexer.start()
+    return indexer
+# start_indexer()
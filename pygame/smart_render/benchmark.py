@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+
+"""Headless benchmark of SmartGroup against pygame's OrderedUpdates.
+
+Scripted scenes are generated from a random seed, so every run (and
+every backend) renders exactly the same frames. Frames are rendered
+with SDL dummy video driver, no display is needed.
+
+For each scene and backend, clear() + draw() + display.update() time,
+number of rectangles and pixels updated are recorded per frame. With
+--verify, every frame is also compared against a full redraw.
+"""
+
+import os
+import random
+import optparse
+from timeit import default_timer
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+from pygame.locals import Rect
+from pygame.sprite import Sprite, OrderedUpdates
+from smart_render import *
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+
+class Scene(object):
+    """Sprites and per frame operations, shared by all backends.
+
+    Operations are tuples: ("move", i, x, y), ("raise", i) and
+    ("alpha", i, a). Subclasses generate them in step(), this one is
+    static: nothing changes, so it measures the cost of idle frames.
+    """
+    name = "static"
+
+    def __init__(self, n, size, frames, seed):
+        self.rng = random.Random(seed)
+        self.w, self.h = size
+        self.specs = [self.make_spec(i) for i in xrange(n)]
+        self.pos = [(x, y) for x, y, w, h, color in self.specs]
+        self.frames = [self.step(f) for f in xrange(frames)]
+    # __init__()
+
+
+    def make_spec(self, i):
+        rng = self.rng
+        w = rng.randint(16, 64)
+        h = rng.randint(16, 64)
+        x = rng.randint(0, self.w - w)
+        y = rng.randint(0, self.h - h)
+        color = (rng.randint(0, 255), rng.randint(0, 255),
+                 rng.randint(0, 255))
+        return (x, y, w, h, color)
+    # make_spec()
+
+
+    def move_op(self, i, dx, dy):
+        x, y, w, h, color = self.specs[i]
+        x, y = self.pos[i]
+        x = max(0, min(self.w - w, x + dx))
+        y = max(0, min(self.h - h, y + dy))
+        self.pos[i] = (x, y)
+        return ("move", i, x, y)
+    # move_op()
+
+
+    def step(self, frame):
+        return []
+    # step()
+# Scene
+
+
+class MoveScene(Scene):
+    """Some sprites move a few pixels every frame."""
+    name = "move"
+    ratio = 0.1
+
+    def step(self, frame):
+        rng = self.rng
+        n = len(self.specs)
+        return [self.move_op(i, rng.randint(-4, 4), rng.randint(-4, 4))
+                for i in rng.sample(xrange(n), max(1, int(n * self.ratio)))]
+    # step()
+# MoveScene
+
+
+class DragScene(Scene):
+    """One sprite raised and dragged over all others, changed every
+    few frames.
+    """
+    name = "drag"
+    drag_frames = 30
+
+    def step(self, frame):
+        rng = self.rng
+        if frame % self.drag_frames == 0:
+            self.drag = rng.randrange(len(self.specs))
+            self.delta = (rng.randint(-8, 8), rng.randint(-8, 8))
+            ops = [("raise", self.drag)]
+        else:
+            ops = []
+        ops.append(self.move_op(self.drag, *self.delta))
+        return ops
+    # step()
+# DragScene
+
+
+class ZOrderScene(Scene):
+    """Static sprites, some raised to top every frame."""
+    name = "zorder"
+    count = 5
+
+    def step(self, frame):
+        rng = self.rng
+        return [("raise", i)
+                for i in rng.sample(xrange(len(self.specs)), self.count)]
+    # step()
+# ZOrderScene
+
+
+class AlphaScene(Scene):
+    """Some sprites fade in and out, others move."""
+    name = "alpha"
+    ratio = 0.2
+
+    def step(self, frame):
+        rng = self.rng
+        n = len(self.specs)
+        faders = int(n * self.ratio)
+        ops = []
+        for i in xrange(faders):
+            a = 255 - abs((frame * 8 + i * 16) % 510 - 255)
+            ops.append(("alpha", i, a))
+        for i in rng.sample(xrange(faders, n), max(1, (n - faders) / 10)):
+            ops.append(self.move_op(i, rng.randint(-4, 4),
+                                    rng.randint(-4, 4)))
+        return ops
+    # step()
+# AlphaScene
+
+
+scenes = dict((s.name, s) for s in (Scene, MoveScene, DragScene,
+                                     ZOrderScene, AlphaScene))
+
+
+def make_image(spec):
+    x, y, w, h, color = spec
+    img = pygame.Surface((w, h)).convert()
+    img.fill(color)
+    return img
+# make_image()
+
+
+class SmartBackend(object):
+    def __init__(self, scene, engine="python"):
+        self.name = "smart-%s" % engine
+        self.group = SmartGroup()
+        self.group.set_split_engine(engine)
+        self.sprites = []
+        for spec in scene.specs:
+            s = SmartSprite(self.group)
+            s.image = make_image(spec)
+            s.rect = Rect(spec[:4])
+            s.show()
+            self.sprites.append(s)
+    # __init__()
+
+
+    def apply(self, ops):
+        sprites = self.sprites
+        for op in ops:
+            s = sprites[op[1]]
+            if op[0] == "move":
+                s.move(op[2], op[3])
+            elif op[0] == "raise":
+                # above_all() just changes order, repaint is up to us
+                self.group.above_all(s)
+                s.dirty = True
+            elif op[0] == "alpha":
+                s.alpha = op[2]
+    # apply()
+
+
+    def render(self, screen, bg):
+        self.group.clear(screen, bg)
+        return self.group.draw(screen)
+    # render()
+
+
+    def full_redraw(self, bg):
+        surface = bg.copy()
+        for s in sorted(self.sprites, key=lambda s: s.zindex):
+            if s.visible:
+                surface.blit(s.image, s.rect)
+        return surface
+    # full_redraw()
+# SmartBackend
+
+
+class OrderedBackend(object):
+    name = "ordered"
+
+    def __init__(self, scene):
+        self.group = OrderedUpdates()
+        self.sprites = []
+        for spec in scene.specs:
+            s = Sprite(self.group)
+            s.image = make_image(spec)
+            s.rect = Rect(spec[:4])
+            self.sprites.append(s)
+    # __init__()
+
+
+    def apply(self, ops):
+        sprites = self.sprites
+        for op in ops:
+            s = sprites[op[1]]
+            if op[0] == "move":
+                s.rect.topleft = (op[2], op[3])
+            elif op[0] == "raise":
+                self.group.remove(s)
+                self.group.add(s)
+            elif op[0] == "alpha":
+                s.image.set_alpha(op[2])
+    # apply()
+
+
+    def render(self, screen, bg):
+        self.group.clear(screen, bg)
+        return self.group.draw(screen)
+    # render()
+
+
+    def full_redraw(self, bg):
+        surface = bg.copy()
+        for s in self.group.sprites():
+            surface.blit(s.image, s.rect)
+        return surface
+    # full_redraw()
+# OrderedBackend
+
+
+def _summary(values):
+    values = sorted(values)
+    n = len(values)
+    if not n:
+        return None
+    return {"avg": sum(values) / float(n),
+            "median": values[n // 2],
+            "p95": values[min(n - 1, int(n * 0.95))],
+            "max": values[-1]}
+# _summary()
+
+
+def _same_pixels(a, b):
+    return pygame.image.tostring(a, "RGB") == pygame.image.tostring(b, "RGB")
+# _same_pixels()
+
+
+def run_backend(backend, scene, screen, bg, verify=False):
+    """Render all scene frames, if verify compare each one against
+    backend's full redraw (not timed) and list those that differ in
+    "mismatches", screen is then fixed so errors do not accumulate.
+    """
+    screen_rect = screen.get_rect()
+    screen.blit(bg, (0, 0))
+    backend.render(screen, bg)
+    pygame.display.update()
+
+    times = []
+    rects = []
+    pixels = []
+    mismatches = []
+    for frame, ops in enumerate(scene.frames):
+        backend.apply(ops)
+        t0 = default_timer()
+        updated = backend.render(screen, bg) or []
+        pygame.display.update(updated)
+        times.append(default_timer() - t0)
+
+        area = 0
+        for r in updated:
+            r = screen_rect.clip(r)
+            area += r.width * r.height
+        rects.append(len(updated))
+        pixels.append(area)
+
+        if verify:
+            ref = backend.full_redraw(bg)
+            if not _same_pixels(screen, ref):
+                mismatches.append(frame)
+                screen.blit(ref, (0, 0))
+
+    result = {"time": _summary(times),
+              "rects": _summary(rects),
+              "pixels": _summary(pixels),
+              "frames": {"time": times, "rects": rects, "pixels": pixels}}
+    if verify:
+        result["mismatches"] = mismatches
+    return result
+# run_backend()
+
+
+def print_result(scene, backend, r):
+    t = r["time"]
+    print "%-7s %-14s %8.3f %8.3f %8.3f %8.1f %10.0f" % \
+          (scene, backend, t["avg"] * 1000, t["p95"] * 1000,
+           t["max"] * 1000, r["rects"]["avg"], r["pixels"]["avg"])
+# print_result()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [scene ...]",
+                                   description="scenes: %s" %
+                                   ", ".join(sorted(scenes)))
+    parser.add_option("-n", "--sprites", type="int", default=200,
+                      help="number of sprites [%default]")
+    parser.add_option("-f", "--frames", type="int", default=300,
+                      help="frames per scene [%default]")
+    parser.add_option("-s", "--seed", type="int", default=0,
+                      help="random seed [%default]")
+    parser.add_option("-r", "--resolution", default="800x600",
+                      help="screen size [%default]")
+    parser.add_option("-e", "--engine", action="append", default=[],
+                      help="SmartGroup split engine, may be repeated "
+                      "(%s) [python]" % ", ".join(sorted(split_engines)))
+    parser.add_option("-O", "--no-ordered", action="store_true",
+                      default=False, help="do not run OrderedUpdates")
+    parser.add_option("-j", "--json", default=None,
+                      help="write JSON report to file")
+    parser.add_option("-V", "--verify", action="store_true", default=False,
+                      help="compare every frame against a full redraw, "
+                      "exit with error if any differs")
+    options, args = parser.parse_args()
+
+    names = args or sorted(scenes)
+    for name in names:
+        if name not in scenes:
+            parser.error("unknown scene: %s" % name)
+    engines = options.engine or ["python"]
+    for engine in engines:
+        if engine not in split_engines:
+            parser.error("unknown split engine: %s" % engine)
+    try:
+        size = tuple(int(v) for v in options.resolution.split("x"))
+    except ValueError, e:
+        parser.error("invalid resolution: %s" % options.resolution)
+
+    pygame.display.init()
+    screen = pygame.display.set_mode(size, 0, 32)
+    bg = pygame.Surface(size).convert()
+    for y in xrange(0, size[1], 16):
+        for x in xrange(0, size[0], 16):
+            if (x + y) % 32 == 0:
+                bg.fill((40, 40, 40), (x, y, 16, 16))
+
+    print "%-7s %-14s %8s %8s %8s %8s %10s" % \
+          ("scene", "backend", "avg ms", "p95 ms", "max ms", "rects",
+           "pixels")
+
+    results = {}
+    failed = []
+    for name in names:
+        scene = scenes[name](options.sprites, size, options.frames,
+                             options.seed)
+        backends = [SmartBackend(scene, e) for e in engines]
+        if not options.no_ordered:
+            backends.append(OrderedBackend(scene))
+
+        results[name] = {}
+        for backend in backends:
+            r = run_backend(backend, scene, screen, bg, options.verify)
+            results[name][backend.name] = r
+            print_result(name, backend.name, r)
+            if r.get("mismatches"):
+                failed.append((name, backend.name, r["mismatches"]))
+
+    if options.json:
+        if json is None:
+            raise SystemExit("No JSON support, install simplejson")
+        report = {"sprites": options.sprites,
+                  "frames": options.frames,
+                  "seed": options.seed,
+                  "resolution": size,
+                  "pygame": pygame.version.ver,
+                  "results": results}
+        f = open(options.json, "w")
+        try:
+            json.dump(report, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    for name, backend, frames in failed:
+        print "%s %s: %d frames differ from full redraw, first: %d" % \
+              (name, backend, len(frames), frames[0])
+    if failed:
+        raise SystemExit(1)
+# main()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,17 @@
 #!/usr/bin/env python
 
-from pygame.locals import Rect, RLEACCEL
+from pygame.locals import Rect, RLEACCEL, SRCALPHA, BLEND_RGBA_MULT
 from pygame.sprite import Sprite, Group
+from operator import attrgetter
+from timeit import default_timer
+from collections import deque, OrderedDict
 import pygame
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 __license__ = "GPL"
 __author__ = "Gustavo Sverzut Barbieri"
 __author_email__ = "barbieri@gmail.com"
@@ -26,7 +34,9 @@ LIMITATIONS
  * One sprite can be in just one group
 """
 
-__all__ = ("SmartGroup", "SmartSprite", "SmartSpriteDrag")
+__all__ = ("SmartGroup", "SmartSprite", "SmartSpriteDrag", "SpatialGrid",
+           "DirtyTiles", "FrameProfiler", "SurfaceCache", "surface_cache",
+           "split_engines")
 
 def _split_internal(clean, index, dirty):
     # Python's access to methods and globals are not the fastest... try to help
@@ -186,9 +196,469 @@ def _cmp_area(r1, r2):
 # _cmp_area()
 
 
+def _split_rects_python(rects):
+    rects.sort(_cmp_area)
+    split_rects = []
+    for r in rects:
+        _split_rects_add(split_rects, r)
+    return split_rects
+# _split_rects_python()
+
+
+def _rects_to_array(rects):
+    a = numpy.array([(r.left, r.top, r.right, r.bottom) for r in rects if r],
+                    dtype=numpy.int32).reshape(-1, 4)
+    return a
+# _rects_to_array()
+
+
+def _coverage_numpy(a, xs, ys):
+    """Count how many rectangles cover each cell of the grid formed by
+    the compressed coordinates xs and ys. Done at once for all
+    rectangles using a 2D difference array and cumulative sums.
+    """
+    x0 = numpy.searchsorted(xs, a[:, 0])
+    y0 = numpy.searchsorted(ys, a[:, 1])
+    x1 = numpy.searchsorted(xs, a[:, 2])
+    y1 = numpy.searchsorted(ys, a[:, 3])
+
+    diff = numpy.zeros((len(ys), len(xs)), dtype=numpy.int32)
+    numpy.add.at(diff, (y0, x0), 1)
+    numpy.add.at(diff, (y0, x1), -1)
+    numpy.add.at(diff, (y1, x0), -1)
+    numpy.add.at(diff, (y1, x1), 1)
+    return diff.cumsum(axis=0).cumsum(axis=1)[:-1, :-1]
+# _coverage_numpy()
+
+
+def _split_rects_numpy(rects):
+    """Non-overlapping decomposition of rects using NumPy.
+
+    Rectangles are rasterized in a grid of their compressed edges, then
+    horizontal runs of covered cells are found for every row and runs
+    with the same columns in consecutive rows are merged, all using
+    batched array operations.
+    """
+    a = _rects_to_array(rects)
+    if len(a) == 0:
+        return []
+    elif len(a) == 1:
+        # rects may have empty ones, filtered out of a
+        return [Rect(a[0, 0], a[0, 1], a[0, 2] - a[0, 0], a[0, 3] - a[0, 1])]
+
+    xs = numpy.unique(a[:, 0::2])
+    ys = numpy.unique(a[:, 1::2])
+    covered = _coverage_numpy(a, xs, ys) > 0
+
+    # horizontal runs: (row, start column, end column)
+    padded = numpy.zeros((covered.shape[0], covered.shape[1] + 2),
+                         dtype=numpy.int8)
+    padded[:, 1:-1] = covered
+    d = numpy.diff(padded, axis=1)
+    rows, c0 = numpy.nonzero(d == 1)
+    c1 = numpy.nonzero(d == -1)[1]
+
+    # merge equal runs in consecutive rows
+    order = numpy.lexsort((rows, c1, c0))
+    rows = rows[order]
+    c0 = c0[order]
+    c1 = c1[order]
+    new = numpy.ones(len(rows), dtype=bool)
+    new[1:] = (c0[1:] != c0[:-1]) | (c1[1:] != c1[:-1]) | \
+              (rows[1:] != rows[:-1] + 1)
+    first = numpy.nonzero(new)[0]
+    last = numpy.append(first[1:], len(rows)) - 1
+
+    left = xs[c0[first]]
+    right = xs[c1[first]]
+    top = ys[rows[first]]
+    bottom = ys[rows[last] + 1]
+
+    result = numpy.column_stack((left, top, right - left, bottom - top))
+    return [Rect(r) for r in result.tolist()]
+# _split_rects_numpy()
+
+
+def _split_rects_check(rects):
+    """Run both python and numpy engines and assert they cover the same
+    area without overlaps. Meant for debugging.
+    """
+    result = _split_rects_python([Rect(r) for r in rects])
+    other = _split_rects_numpy(rects)
+
+    a = _rects_to_array(rects)
+    ra = _rects_to_array(result)
+    oa = _rects_to_array(other)
+    if len(a) == 0:
+        assert len(ra) == 0 and len(oa) == 0
+        return result
+
+    edges = numpy.concatenate((a, ra, oa))
+    xs = numpy.unique(edges[:, 0::2])
+    ys = numpy.unique(edges[:, 1::2])
+    expected = _coverage_numpy(a, xs, ys) > 0
+    for name, r in (("python", ra), ("numpy", oa)):
+        cov = _coverage_numpy(r, xs, ys)
+        assert cov.max() <= 1, "%s engine returned overlapping rects" % name
+        assert (expected == (cov > 0)).all(), \
+               "%s engine coverage differs" % name
+    return result
+# _split_rects_check()
+
+
+class DirtyTiles(object):
+    """Split engine that marks damage in a bitmap of fixed size tiles.
+
+    Each tile row is a bitmask (python long), damaged rectangles set
+    the bits of tiles they touch, then runs of set bits become update
+    rectangles, also merging consecutive rows with the same mask.
+    Result covers more pixels than exact splitting, but cost is bounded
+    by the number of tiles, not by fragmentation.
+    """
+    __slots__ = ("tile_size",)
+
+    def __init__(self, tile_size=32):
+        self.tile_size = tile_size
+    # __init__()
+
+
+    def expand(self, r):
+        """Rectangle aligned to tile boundaries containing r."""
+        ts = self.tile_size
+        left = r.left // ts * ts
+        top = r.top // ts * ts
+        right = -(-r.right // ts) * ts
+        bottom = -(-r.bottom // ts) * ts
+        return Rect(left, top, right - left, bottom - top)
+    # expand()
+
+
+    def __call__(self, rects):
+        ts = self.tile_size
+        rows = {}
+        rows_get = rows.get
+        for r in rects:
+            left = max(r.left, 0)
+            top = max(r.top, 0)
+            right = r.right
+            bottom = r.bottom
+            if right <= left or bottom <= top:
+                continue
+
+            tx0 = left // ts
+            tx1 = (right - 1) // ts
+            mask = ((1L << (tx1 - tx0 + 1)) - 1) << tx0
+            for ty in xrange(top // ts, (bottom - 1) // ts + 1):
+                rows[ty] = rows_get(ty, 0) | mask
+
+        tys = rows.keys()
+        tys.sort()
+        n = len(tys)
+        result = []
+        result_append = result.append
+        i = 0
+        while i < n:
+            ty = tys[i]
+            mask = rows[ty]
+            j = i + 1
+            while j < n and tys[j] == ty + j - i and rows[tys[j]] == mask:
+                j += 1
+            top = ty * ts
+            height = (j - i) * ts
+            i = j
+
+            x = 0
+            while mask:
+                while not mask & 1:
+                    mask >>= 1
+                    x += 1
+                start = x
+                while mask & 1:
+                    mask >>= 1
+                    x += 1
+                result_append(Rect(start * ts, top, (x - start) * ts, height))
+        return result
+    # __call__()
+# DirtyTiles
+
+
+split_engines = {"python": _split_rects_python,
+                 "tiles": DirtyTiles(32)}
+if numpy is not None:
+    split_engines["numpy"] = _split_rects_numpy
+    split_engines["check"] = _split_rects_check
+
+
+_zindex_key = attrgetter("zindex")
+
+
+def _rect_subtract(r, holes):
+    """Parts of r not covered by any of holes, as disjoint rectangles."""
+    parts = [r]
+    for h in holes:
+        remaining = []
+        for p in parts:
+            c = p.clip(h)
+            if not c:
+                remaining.append(p)
+                continue
+
+            if c.top > p.top:
+                remaining.append(Rect(p.left, p.top, p.width, c.top - p.top))
+            if c.bottom < p.bottom:
+                remaining.append(Rect(p.left, c.bottom,
+                                      p.width, p.bottom - c.bottom))
+            if c.left > p.left:
+                remaining.append(Rect(p.left, c.top,
+                                      c.left - p.left, c.height))
+            if c.right < p.right:
+                remaining.append(Rect(c.right, c.top,
+                                      p.right - c.right, c.height))
+        parts = remaining
+        if not parts:
+            break
+    return parts
+# _rect_subtract()
+
+
+def _blits_fallback(surface, blit_sequence, doreturn=1):
+    """Surface.blits() replacement for pygame older than 1.9.4."""
+    blit = surface.blit
+    if doreturn:
+        return [blit(*b) for b in blit_sequence]
+    for b in blit_sequence:
+        blit(*b)
+# _blits_fallback()
+
+
+# blit many (source, dest[, area]) in a single call, avoid python overhead
+_blits = getattr(pygame.Surface, "blits", _blits_fallback)
+
+
+class SpatialGrid(object):
+    """Uniform grid of fixed size cells, each one with the set of items
+    whose rectangle touch it.
+
+    Queries return candidates, callers must still clip against item
+    rectangle, but just nearby items are considered.
+    """
+    __slots__ = ("cell_size", "_cells", "_where")
+
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self._cells = {}
+        self._where = {}
+    # __init__()
+
+
+    def _span(self, r):
+        if not r:
+            return None
+        cs = self.cell_size
+        return (r.left // cs, r.top // cs,
+                (r.right - 1) // cs, (r.bottom - 1) // cs)
+    # _span()
+
+
+    def update(self, item, rect):
+        span = self._span(rect)
+        old = self._where.get(item)
+        if old == span:
+            return
+
+        cells = self._cells
+        if old:
+            x0, y0, x1, y1 = old
+            for y in xrange(y0, y1 + 1):
+                for x in xrange(x0, x1 + 1):
+                    c = cells[(x, y)]
+                    c.discard(item)
+                    if not c:
+                        del cells[(x, y)]
+            del self._where[item]
+
+        if span:
+            x0, y0, x1, y1 = span
+            for y in xrange(y0, y1 + 1):
+                for x in xrange(x0, x1 + 1):
+                    c = cells.get((x, y))
+                    if c is None:
+                        cells[(x, y)] = c = set()
+                    c.add(item)
+            self._where[item] = span
+    # update()
+
+
+    def remove(self, item):
+        self.update(item, None)
+    # remove()
+
+
+    def query(self, rect):
+        span = self._span(rect)
+        if not span:
+            return set()
+
+        x0, y0, x1, y1 = span
+        cells_get = self._cells.get
+        if x0 == x1 and y0 == y1:
+            return set(cells_get((x0, y0), ()))
+
+        found = set()
+        found_update = found.update
+        for y in xrange(y0, y1 + 1):
+            for x in xrange(x0, x1 + 1):
+                c = cells_get((x, y))
+                if c:
+                    found_update(c)
+        return found
+    # query()
+
+
+    def query_point(self, x, y):
+        cs = self.cell_size
+        return self._cells.get((x // cs, y // cs), ())
+    # query_point()
+# SpatialGrid
+
+
+
+def _surface_bytes(surface):
+    w, h = surface.get_size()
+    return w * h * surface.get_bytesize()
+# _surface_bytes()
+
+
+class SurfaceCache(object):
+    """Memory bounded LRU cache of converted, scaled and faded surfaces.
+
+    Variants are keyed by (id(image), size, alpha, convert, has_alpha)
+    and are created once, converted to display format and with RLEACCEL,
+    so animations (fades, zoom steps) just pick them from cache. Entries
+    keep a reference to their source image, so its id() is not reused
+    while cached.
+
+    Least recently used variants are dropped when they take more than
+    max_bytes of pixel data.
+    """
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+    # __init__()
+
+
+    def __len__(self):
+        return len(self._entries)
+    # __len__()
+
+
+    def _lookup(self, key):
+        e = self._entries.pop(key, None)
+        if e is None:
+            self.misses += 1
+            return None
+        self._entries[key] = e
+        self.hits += 1
+        return e[0]
+    # _lookup()
+
+
+    def _store(self, key, surface, source):
+        n = _surface_bytes(surface)
+        self._entries[key] = (surface, source, n)
+        self.bytes += n
+
+        entries = self._entries
+        while self.bytes > self.max_bytes and len(entries) > 1:
+            key, e = entries.popitem(False)
+            self.bytes -= e[2]
+    # _store()
+
+
+    def load(self, filename):
+        """Load image file, unconverted, shared by all users."""
+        key = ("file", filename)
+        img = self._lookup(key)
+        if img is None:
+            img = pygame.image.load(filename)
+            self._store(key, img, None)
+        return img
+    # load()
+
+
+    def get(self, image, size=None, alpha=255, convert=True, has_alpha=None):
+        """Variant of image scaled to size, with alpha and converted to
+        display format (convert_alpha() if has_alpha). If has_alpha is
+        None, it is image per-pixel alpha. Source image is never changed.
+        """
+        if size is not None:
+            size = tuple(size)
+            if size == image.get_size():
+                size = None
+        if has_alpha is None:
+            has_alpha = bool(image.get_flags() & SRCALPHA)
+        if size is None and alpha == 255 and not convert:
+            return image
+
+        key = (id(image), size, alpha, convert, has_alpha)
+        img = self._lookup(key)
+        if img is None:
+            img = self._make(image, size, alpha, convert, has_alpha)
+            self._store(key, img, image)
+        return img
+    # get()
+
+
+    def _make(self, image, size, alpha, convert, has_alpha):
+        img = image
+        if size is not None:
+            if img.get_bitsize() in (24, 32):
+                img = pygame.transform.smoothscale(img, size)
+            else:
+                img = pygame.transform.scale(img, size)
+
+        if convert and pygame.display.get_surface() is not None:
+            if has_alpha:
+                img = img.convert_alpha()
+            else:
+                img = img.convert()
+        elif img is image:
+            img = img.copy()
+
+        if has_alpha and img.get_flags() & SRCALPHA:
+            if alpha != 255:
+                # surface alpha is ignored with per-pixel alpha, scale it
+                img.fill((255, 255, 255, alpha), None, BLEND_RGBA_MULT)
+            img.set_alpha(255, RLEACCEL)
+        else:
+            key = img.get_colorkey()
+            if key is not None:
+                img.set_colorkey(key, RLEACCEL)
+            if alpha != 255:
+                img.set_alpha(alpha, RLEACCEL)
+        return img
+    # _make()
+
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+    # clear()
+# SurfaceCache
+
+
+# shared by all sprites, see SmartSprite.set_source()
+surface_cache = SurfaceCache()
+
+
 class SmartSprite(Sprite):
-    __slots__ = ("_group", "_zindex", "_dirty", "_alpha", "_visible",
+    __slots__ = ("_group", "_zindex", "_z_below", "_z_above",
+                 "_dirty", "_alpha", "_visible", "_source", "_size",
                  "damaged", "last_state", "rect", "image")
+    surface_cache = surface_cache
 
     def __init__(self, *args):
         if not hasattr(self, "image"):
@@ -199,8 +669,12 @@ class SmartSprite(Sprite):
         self._group = args[0]
         self._visible = False
         self._zindex = 0
+        self._z_below = None
+        self._z_above = None
         self._dirty = True
         self._alpha = 255
+        self._source = None
+        self._size = None
         self.damaged = False
         self.damaged_areas = []
         self.last_state = None
@@ -222,7 +696,7 @@ class SmartSprite(Sprite):
     def set_dirty(self, v):
         self._dirty = v
         if v:
-            self._group.dirty = True
+            self._group.sprite_changed(self)
     # set_dirty()
     dirty = property(get_dirty, set_dirty)
 
@@ -237,13 +711,70 @@ class SmartSprite(Sprite):
             return
 
         self._alpha = v
-        if self.image:
+        if self._source is not None:
+            self._update_image()
+        elif self.image:
             self.image.set_alpha(v, RLEACCEL)
             self.dirty = True
     # set_alpha()
     alpha = property(get_alpha, set_alpha)
 
 
+    def _update_image(self):
+        self.image = self.surface_cache.get(self._source, self._size,
+                                            self._alpha)
+        self.rect.size = self.image.get_size()
+        self.dirty = True
+    # _update_image()
+
+
+    def get_source(self):
+        return self._source
+    # get_source()
+
+
+    def set_source(self, image, size=None):
+        """Use cached variants of image, as required by alpha and size,
+        instead of changing it. Use None to stop.
+        """
+        self._source = image
+        self._size = size
+        if image is not None:
+            self._update_image()
+    # set_source()
+    source = property(get_source, set_source)
+
+
+    def get_size(self):
+        return self.rect.size
+    # get_size()
+
+
+    def set_size(self, size):
+        """Scale to size, requires source image."""
+        if self._source is None:
+            raise ValueError("set_size() requires a source image")
+        self._size = size
+        self._update_image()
+    # set_size()
+    size = property(get_size, set_size)
+
+
+    def get_opaque(self):
+        """Whether sprite fully hides what is below its rect: no
+        per-pixel alpha, no colorkey and no transparency.
+        """
+        img = self.image
+        if img is None or self._alpha != 255:
+            return False
+        if img.get_flags() & SRCALPHA or img.get_colorkey() is not None:
+            return False
+        a = img.get_alpha()
+        return a is None or a == 255
+    # get_opaque()
+    opaque = property(get_opaque)
+
+
     def get_zindex(self):
         return self._zindex
     # get_zindex()
@@ -385,24 +916,241 @@ class SmartSpriteState(object):
 # SmartSpriteState
 
 
+class FrameProfiler(object):
+    """Records per frame timings and counters of a SmartGroup.
+
+    Frames start at SmartGroup.clear() (or draw() if not cleared) and
+    end at SmartGroup.draw(). Times are in seconds, for phases:
+
+     * damage: find changed sprites and damage sprites above them;
+     * split_clear: split rectangles to restore;
+     * restore: blit background and sprites below into restored areas;
+     * blit: blit dirty and damaged sprites;
+     * split_draw: split rectangles to update on display.
+
+    Counters are dirty_sprites, damaged_sprites, clear_rects,
+    draw_rects and pixels (total blitted area).
+
+    Last frames are kept in history, see last() and averages().
+    """
+    phases = ("damage", "split_clear", "restore", "blit", "split_draw")
+    counters = ("dirty_sprites", "damaged_sprites", "clear_rects",
+                "draw_rects", "pixels")
+
+    def __init__(self, history=120):
+        self.history = deque(maxlen=history)
+        self.current = None
+        self._start = None
+    # __init__()
+
+
+    def begin(self):
+        frame = dict.fromkeys(self.phases + self.counters, 0)
+        self.current = frame
+        self._start = default_timer()
+        return frame
+    # begin()
+
+
+    def end(self):
+        frame = self.current
+        frame["total"] = default_timer() - self._start
+        self.history.append(frame)
+        self.current = None
+        return frame
+    # end()
+
+
+    def last(self):
+        if self.history:
+            return self.history[-1]
+        return None
+    # last()
+
+
+    def averages(self):
+        n = len(self.history)
+        if not n:
+            return None
+
+        avg = {}
+        for key in self.phases + self.counters + ("total",):
+            avg[key] = sum([f[key] for f in self.history]) / float(n)
+        return avg
+    # averages()
+
+
+    def reset(self):
+        self.history.clear()
+    # reset()
+
+
+    def draw_overlay(self, surface, font=None, pos=(0, 0),
+                     color=(255, 255, 0), bgcolor=(0, 0, 0)):
+        """Render averages over surface, returns the changed rectangle.
+
+        It should be called after SmartGroup.draw(), and the returned
+        rectangle also given to pygame.display.update().
+        """
+        avg = self.averages()
+        if not avg:
+            return None
+        if font is None:
+            font = pygame.font.Font(None, 16)
+
+        lines = ["frame %5.2fms (%d frames)" %
+                 (avg["total"] * 1000, len(self.history))]
+        for p in self.phases:
+            lines.append("%-11s %5.2fms" % (p, avg[p] * 1000))
+        lines.append("sprites %0.1f dirty, %0.1f damaged" %
+                     (avg["dirty_sprites"], avg["damaged_sprites"]))
+        lines.append("rects %0.1f clear, %0.1f draw" %
+                     (avg["clear_rects"], avg["draw_rects"]))
+        lines.append("pixels %d" % avg["pixels"])
+
+        texts = [font.render(l, True, color, bgcolor) for l in lines]
+        w = max([t.get_width() for t in texts])
+        h = sum([t.get_height() for t in texts])
+        area = Rect(pos, (w, h))
+        surface.fill(bgcolor, area)
+        y = area.top
+        for t in texts:
+            surface.blit(t, (area.left, y))
+            y += t.get_height()
+        return area
+    # draw_overlay()
+# FrameProfiler
+
+
 class SmartGroup(Group):
+    """Group that redraws just what changed.
+
+    Visible sprites are kept in a SpatialGrid, so damage propagation in
+    clear() and hit testing in item_at() just look at nearby sprites,
+    and changed/damaged sprites are tracked in sets, so frame cost
+    depends on what changed, not on number of sprites.
+
+    Z-order is a doubly linked list from bottom to top, zindex are
+    sparse keys (zgap apart) so adding, removing, raising and lowering
+    sprites are O(1) and never renumber other sprites.
+    """
+    cell_size = 64
+    zgap = 1024 # distance between zindex of sprites raised/lowered
+    occlusion_culling = True
+    split_engine = "python"
+    profiler = None
+
     def __init__(self, *sprites):
-        self._spritelist = []
+        self.set_split_engine(self.split_engine)
+        self._top = None
+        self._bottom = None
+        self._grid = SpatialGrid(self.cell_size)
+        self._changed = set()
+        self._damaged = set()
         Group.__init__(self, *sprites)
     # __init__()
 
 
+    def set_split_engine(self, engine):
+        """Select how dirty rectangles are split in non-overlapping ones,
+        one of split_engines keys: "python" (default), "numpy", "tiles"
+        (32x32 dirty tiles) or "check" (runs both python and numpy and
+        compare coverage, for debugging). Engine objects, like
+        DirtyTiles(16), may also be given.
+        """
+        if isinstance(engine, basestring):
+            self.split_engine = engine
+            engine = split_engines[engine]
+        self._split_rects = engine
+        self._expand_rect = getattr(engine, "expand", None)
+    # set_split_engine()
+
+
+    def enable_profiling(self, history=120):
+        """Start recording frame statistics, returns the FrameProfiler."""
+        if self.profiler is None:
+            self.profiler = FrameProfiler(history)
+        return self.profiler
+    # enable_profiling()
+
+
+    def disable_profiling(self):
+        self.profiler = None
+    # disable_profiling()
+
+
+    def sprite_changed(self, sprite):
+        if sprite not in self.spritedict:
+            return
+
+        self.dirty = True
+        self._changed.add(sprite)
+        if sprite.visible:
+            self._grid.update(sprite, sprite.rect)
+        else:
+            self._grid.remove(sprite)
+    # sprite_changed()
+
+
     def sprites(self):
-        return iter(self._spritelist)
+        lst = []
+        s = self._bottom
+        while s is not None:
+            lst.append(s)
+            s = s._z_above
+        return iter(lst)
     # sprites()
 
 
+    def _link_top(self, sprite):
+        top = self._top
+        sprite._z_below = top
+        sprite._z_above = None
+        if top is None:
+            self._bottom = sprite
+            sprite.zindex = 0
+        else:
+            top._z_above = sprite
+            sprite.zindex = top.zindex + self.zgap
+        self._top = sprite
+    # _link_top()
+
+
+    def _link_bottom(self, sprite):
+        bottom = self._bottom
+        sprite._z_above = bottom
+        sprite._z_below = None
+        if bottom is None:
+            self._top = sprite
+            sprite.zindex = 0
+        else:
+            bottom._z_below = sprite
+            sprite.zindex = bottom.zindex - self.zgap
+        self._bottom = sprite
+    # _link_bottom()
+
+
+    def _unlink(self, sprite):
+        below = sprite._z_below
+        above = sprite._z_above
+        if below is None:
+            self._bottom = above
+        else:
+            below._z_above = above
+        if above is None:
+            self._top = below
+        else:
+            above._z_below = below
+        sprite._z_below = None
+        sprite._z_above = None
+    # _unlink()
+
+
     def add_internal(self, sprite):
         Group.add_internal(self, sprite)
-        sprite.zindex = len(self._spritelist)
-        self._spritelist.append(sprite)
+        self._link_top(sprite)
         if sprite.visible:
-            self.dirty = True
+            self.sprite_changed(sprite)
     # add_internal()
 
 
@@ -410,8 +1158,11 @@ class SmartGroup(Group):
         if sprite.last_state:
             self.lostsprites.append(sprite.last_state.rect)
 
-        del self._spritelist[sprite.zindex]
+        self._unlink(sprite)
         sprite.zindex = None
+        self._grid.remove(sprite)
+        self._changed.discard(sprite)
+        self._damaged.discard(sprite)
 
         if sprite.visible:
             self.dirty = True
@@ -421,164 +1172,278 @@ class SmartGroup(Group):
 
 
     def sort(self):
-        self._spritelist.sort()
-        for i, o in enumerate(self._spritelist):
-            o.zindex = i
+        """Reorder sprites by their zindex, useful if it was changed by
+        hand, and renumber them.
+        """
+        lst = list(self.sprites())
+        lst.sort()
+        self._top = self._bottom = None
+        for o in lst:
+            self._link_top(o)
     # sort()
 
 
     def above_all(self, sprite):
-        if not sprite or sprite.zindex + 1 == len(self._spritelist):
+        if not sprite or sprite is self._top:
             return
 
-        spritelist = self._spritelist
-        del spritelist[sprite.zindex]
-
-        i = sprite.zindex
-        size = len(spritelist)
-        while i < size:
-            s = spritelist[i]
-            s.zindex = i
-            i += 1
-
-        sprite.zindex = i
-        spritelist.append(sprite)
+        self._unlink(sprite)
+        self._link_top(sprite)
     # above_all()
 
 
     def below_all(self, sprite):
-        if not sprite:
+        if not sprite or sprite is self._bottom:
             return
 
-        spritelist = self._spritelist
-        del spritelist[sprite.zindex]
-
-        spritelist.insert(0, sprite)
-        for i, s in enumerate(spritelist):
-            s.zindex = i
+        self._unlink(sprite)
+        self._link_bottom(sprite)
     # below_all()
 
 
     def __len__(self):
-        return len(self._spritelist)
+        return len(self.spritedict)
     # __len__()
 
 
-    def item_at(self, x, y):
-        spritelist = self._spritelist
+    def _occluder(self, r, candidates=None):
+        """Topmost visible and opaque sprite containing r, if any."""
+        if candidates is None:
+            candidates = self._grid.query(r)
 
-        i = len(spritelist) - 1
-        while i >= 0:
-            o = spritelist[i]
-            i -= 1
+        found = None
+        for s in candidates:
+            if s.visible and (found is None or s.zindex > found.zindex) and \
+               s.rect.contains(r) and s.opaque:
+                found = s
+        return found
+    # _occluder()
 
+
+    def item_at(self, x, y):
+        found = None
+        for o in self._grid.query_point(x, y):
             if o.rect.collidepoint(x, y):
-                return o
+                if found is None or found.zindex < o.zindex:
+                    found = o
 
-        return None
+        return found
     # item_at()
 
 
-    def clear(self, surface, bg):
-        # make heavily used symbols local, avoid python performance hit
-        split_rects_add = _split_rects_add
-        spritelist = self._spritelist
-        spritelist_len = len(spritelist)
-        changed = self.lostsprites
-        changed_append = changed.append
+    def _damage_above(self, rect, z):
+        """Damage rect of visible sprites not below z that are not dirty."""
+        damaged_set_add = self._damaged.add
+        for s in self._grid.query(rect):
+            if s.zindex < z or s.dirty or not s.visible:
+                continue
 
-        for sprite in spritelist:
-            if not sprite.last_state_changed():
+            r = rect.clip(s.rect)
+            if not r:
                 continue
 
-            state = sprite.last_state
-            changed_append(state.rect)
+            if s.damaged:
+                # keep areas disjoint, translucent sprites would be
+                # blended twice where they overlap
+                parts = _rect_subtract(r, [d for d, a in s.damaged_areas])
+            else:
+                parts = (r,)
 
-            i = sprite.zindex
-            while i < spritelist_len:
-                s2 = spritelist[i]
-                i += 1
+            for r in parts:
+                r2 = Rect((r.left - s.rect.left, r.top - s.rect.top), r.size)
+                s.damaged_areas.append((r, r2))
+            s.damaged = True
+            damaged_set_add(s)
+    # _damage_above()
 
-                if s2.dirty or not s2.visible:
-                    continue
 
-                r = state.rect.clip(s2.rect)
-                if r:
-                    r2 = Rect((r.left - s2.rect.left,
-                               r.top - s2.rect.top),
-                              r.size)
-                    s2.damaged_areas.append((r, r2))
-                    s2.damaged = True
-        # for in spritelist
-
-        changed.sort(_cmp_area)
-        split_rects = []
-        for r in changed:
-            split_rects_add(split_rects, r)
-
-        surface_blit = surface.blit
+    def clear(self, surface, bg):
+        # make heavily used symbols local, avoid python performance hit
+        grid_query = self._grid.query
+        damage_above = self._damage_above
+        expand_rect = self._expand_rect
+        changed = self.lostsprites
+        changed_append = changed.append
+        prof = self.profiler
+        if prof:
+            frame = prof.begin()
+            t0 = default_timer()
+
+        for sprite in self._changed:
+            # old area is restored, new one is just covered by draw()
+            # unless the sprite is translucent and blends with what is
+            # below. Sprites above both are damaged
+            state = sprite.last_state
+            opaque = sprite.opaque
+            areas = []
+            if state and (state.changed() or not opaque):
+                areas.append((state.rect, True))
+            if sprite.visible and not (areas and areas[0][0] == sprite.rect):
+                # split engines may change rects, do not give them ours
+                areas.append((Rect(sprite.rect), not opaque))
+
+            z = sprite.zindex
+            for state_rect, restore in areas:
+                if restore:
+                    if expand_rect:
+                        # restored area is larger than sprite, damage all
+                        state_rect = expand_rect(state_rect)
+                    changed_append(state_rect)
+                damage_above(state_rect, z)
+        # for in changed sprites
+
+        if prof:
+            t1 = default_timer()
+            frame["damage"] = t1 - t0
+            t0 = t1
+
+        split_rects = self._split_rects(changed)
+
+        if prof:
+            t1 = default_timer()
+            frame["split_clear"] = t1 - t0
+            frame["clear_rects"] = len(split_rects)
+            t0 = t1
+            pixels = 0
+
+        surface_rect = surface.get_rect()
+        occluder = None
+        find_occluder = self.occlusion_culling and self._occluder
+        blits = []
+        blits_append = blits.append
         dirty = []
         dirty_append = dirty.append
         for r in split_rects:
-            r = surface_blit(bg, r, r)
+            candidates = grid_query(r)
+            if find_occluder:
+                occluder = find_occluder(r, candidates)
+
+            r = r.clip(surface_rect)
+            if occluder is None:
+                blits_append((bg, r, r))
+                if prof:
+                    pixels += r.width * r.height
+                # damaged sprites are also redrawn here, as r may come
+                # from some other sprite they are not above of, but just
+                # outside their damaged areas that draw() will blit
+                below = [s for s in candidates if s.visible and not s.dirty]
+            else:
+                # r will be fully covered by occluder, either here or in
+                # draw() if it's dirty, skip background and what is below
+                z = occluder.zindex
+                below = [s for s in candidates
+                         if s.visible and not s.dirty and s.zindex >= z]
             dirty_append(r)
 
-            for s in spritelist:
-                if s.dirty or s.damaged or not s.visible:
-                    continue
-
+            below.sort(key=_zindex_key)
+            for s in below:
                 state = s.last_state
                 r2 = r.clip(state.rect)
-                if r2:
+                if not r2:
+                    continue
+
+                if s.damaged:
+                    # blitting twice would blend translucent sprites twice
+                    parts = _rect_subtract(
+                        r2, [d for d, a in s.damaged_areas])
+                else:
+                    parts = (r2,)
+
+                for r2 in parts:
                     r3 = Rect(r2.left - s.rect.left, r2.top - s.rect.top,
                               r2.width, r2.height)
-                    surface_blit(s.image, r2, r3)
-            # for in spritelist
+                    blits_append((s.image, r2, r3))
+                    if prof:
+                        pixels += r2.width * r2.height
+            # for in sprites below
         # for in split_rects
 
+        _blits(surface, blits, 0)
+
+        if prof:
+            frame["restore"] = default_timer() - t0
+            frame["pixels"] = pixels
+
         self.lostsprites = dirty
     # clear()
 
 
     def draw(self, surface):
         if not self.dirty:
+            if self.profiler and self.profiler.current:
+                self.profiler.end()
             return
 
         # make heavily used symbols local, avoid python performance hit
-        split_rects_add = _split_rects_add
+        grid_update = self._grid.update
+        prof = self.profiler
+        if prof:
+            frame = prof.current or prof.begin()
+            frame["dirty_sprites"] = len(self._changed)
+            frame["damaged_sprites"] = len(self._damaged)
+            t0 = default_timer()
+            pixels = 0
 
         dirty = self.lostsprites
-        dirty_append = dirty.append
         self.lostsprites = []
 
-        surface_blit = surface.blit
+        blits = []
+        blits_append = blits.append
+        find_occluder = self.occlusion_culling and self._occluder
+
+        sprites = list(self._changed | self._damaged)
+        sprites.sort(key=_zindex_key)
+        self._changed = set()
+        self._damaged = set()
 
-        for s in self._spritelist:
+        for s in sprites:
             if not s.visible:
                 s.last_state = None
                 continue
 
             elif s.dirty:
-                r = surface_blit(s.image, s.rect)
                 s.last_state = SmartSpriteState(s)
                 s.dirty = False
-                dirty_append(r)
+                grid_update(s, s.rect)
+
+                if find_occluder:
+                    o = find_occluder(s.rect)
+                    if o is not None and o.zindex > s.zindex:
+                        continue
+
+                blits_append((s.image, s.rect))
 
             elif s.damaged:
                 for dst, area in s.damaged_areas:
-                    r = surface_blit(s.image, dst, area)
-                    dirty_append(r)
+                    if find_occluder:
+                        o = find_occluder(dst)
+                        if o is not None and o.zindex > s.zindex:
+                            continue
+
+                    blits_append((s.image, dst, area))
 
                 del s.damaged_areas[:]
                 s.damaged = False
 
-        dirty.sort(_cmp_area)
-        split_rects = []
-        for r in dirty:
-            split_rects_add(split_rects, r)
+        drawn = _blits(surface, blits, 1)
+        dirty.extend(drawn)
+
+        if prof:
+            t1 = default_timer()
+            frame["blit"] = t1 - t0
+            for r in drawn:
+                pixels += r.width * r.height
+            frame["pixels"] += pixels
+            t0 = t1
+
+        split_rects = self._split_rects(dirty)
+
+        if prof:
+            frame["split_draw"] = default_timer() - t0
+            frame["draw_rects"] = len(split_rects)
+            prof.end()
 
         self.dirty = False
         return split_rects
     # draw()
 # SmartGroup
-
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""Headless check of SmartGroup split engines.
+
+Every case is run with the "check" engine (if NumPy is available),
+that asserts python and numpy engines cover the same area without
+overlaps.
+
+Render cases change translucent sprites and compare what SmartGroup
+drew, with every split engine, against a full redraw of the scene.
+"""
+
+import os
+import sys
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+from pygame.locals import Rect
+from smart_render import SmartGroup, SmartSprite, split_engines
+
+SCREEN_SIZE = (160, 120)
+
+cases = (
+    ("empty", []),
+    ("single", [Rect(10, 10, 5, 5)]),
+    ("single-empty", [Rect(0, 0, 0, 0)]),
+    ("empty-and-one", [Rect(0, 0, 0, 0), Rect(10, 10, 5, 5)]),
+    ("one-and-empty", [Rect(10, 10, 5, 5), Rect(20, 20, 0, 3)]),
+    ("disjoint", [Rect(0, 0, 10, 10), Rect(20, 0, 10, 10)]),
+    ("overlap", [Rect(0, 0, 10, 10), Rect(5, 5, 10, 10)]),
+    ("contained", [Rect(0, 0, 20, 20), Rect(5, 5, 5, 5)]),
+    ("cross", [Rect(10, 0, 5, 30), Rect(0, 10, 30, 5)]),
+    ("empty-mixed", [Rect(0, 0, 10, 10), Rect(50, 50, 0, 0),
+                     Rect(5, 5, 10, 10), Rect(3, 3, 4, 0)]),
+    )
+
+
+# sprites are (rect, color, alpha), from bottom to top. Steps are lists
+# of (sprite index, attribute, value) applied before each frame.
+render_cases = (
+    ("alpha-above-moved",
+     [(Rect(10, 10, 40, 40), (200, 40, 9), 255),
+      (Rect(30, 30, 40, 40), (9, 200, 40), 128)],
+     [[(0, "rect", Rect(20, 15, 40, 40))],
+      [(0, "rect", Rect(25, 25, 40, 40))]]),
+    ("alpha-damaged-twice",
+     [(Rect(10, 10, 50, 30), (200, 40, 9), 200),
+      (Rect(40, 20, 30, 50), (40, 9, 200), 200),
+      (Rect(20, 15, 60, 40), (9, 200, 40), 150)],
+     [[(0, "alpha", 100), (1, "alpha", 100)],
+      [(0, "rect", Rect(15, 10, 50, 30)), (1, "alpha", 255)]]),
+    ("alpha-restored-elsewhere",
+     [(Rect(10, 10, 40, 40), (200, 40, 9), 255),
+      (Rect(30, 30, 40, 40), (9, 200, 40), 128),
+      (Rect(60, 40, 40, 40), (40, 9, 200), 255)],
+     [[(0, "alpha", 150), (2, "rect", Rect(55, 35, 40, 40))]]),
+    ("alpha-same-state",
+     [(Rect(10, 10, 40, 40), (200, 40, 9), 128)],
+     [[(0, "alpha", 200), (0, "alpha", 128)],
+      [(0, "dirty", True)]]),
+    )
+
+
+def check_split():
+    if "check" not in split_engines:
+        print "split cases skipped, NumPy is required to check engines"
+        return 0
+
+    check = split_engines["check"]
+    failures = 0
+    for name, rects in cases:
+        try:
+            check(list(rects))
+        except AssertionError, e:
+            print "%-25s FAILED: %s" % (name, e)
+            failures += 1
+        else:
+            print "%-25s ok" % (name,)
+    return failures
+# check_split()
+
+
+def full_redraw(group, bg):
+    ref = bg.copy()
+    for s in sorted(group.sprites(), key=lambda s: s.zindex):
+        if s.visible:
+            ref.blit(s.image, s.rect)
+    return ref
+# full_redraw()
+
+
+def run_render_case(screen, bg, engine, sprites, steps):
+    """Returns the number of the first frame that differs from a full
+    redraw, or None.
+    """
+    screen.blit(bg, (0, 0))
+    group = SmartGroup()
+    group.set_split_engine(engine)
+    objs = []
+    for rect, color, alpha in sprites:
+        s = SmartSprite(group)
+        s.image = pygame.Surface(rect.size).convert()
+        s.image.fill(color)
+        s.rect = Rect(rect)
+        s.alpha = alpha
+        s.show()
+        objs.append(s)
+
+    for i, step in enumerate([[]] + list(steps)):
+        for idx, attr, value in step:
+            s = objs[idx]
+            if attr == "rect":
+                s.move(value.left, value.top)
+            else:
+                setattr(s, attr, value)
+
+        group.clear(screen, bg)
+        group.draw(screen)
+        ref = full_redraw(group, bg)
+        if pygame.image.tostring(screen, "RGB") != \
+           pygame.image.tostring(ref, "RGB"):
+            return i
+    return None
+# run_render_case()
+
+
+def check_render():
+    pygame.display.init()
+    screen = pygame.display.set_mode(SCREEN_SIZE, 0, 32)
+    bg = pygame.Surface(SCREEN_SIZE).convert()
+    w, h = SCREEN_SIZE
+    for y in xrange(0, h, 8):
+        for x in xrange(0, w, 8):
+            bg.fill(((x * 3) % 256, (y * 5) % 256, (x + y) % 256),
+                    (x, y, 8, 8))
+
+    failures = 0
+    for name, sprites, steps in render_cases:
+        for engine in sorted(split_engines):
+            label = "%s/%s" % (name, engine)
+            frame = run_render_case(screen, bg, engine, sprites, steps)
+            if frame is not None:
+                print "%-25s FAILED: frame %d differs from full redraw" % \
+                      (label, frame)
+                failures += 1
+            else:
+                print "%-25s ok" % (label,)
+
+    pygame.display.quit()
+    return failures
+# check_render()
+
+
+def main():
+    failures = check_split() + check_render()
+    if failures:
+        sys.exit(1)
+# main()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import sys
 import pygame
 from smart_render import *
 from pygame.locals import *
@@ -9,55 +10,25 @@ SCREEN_DEPTH = 0
 FPS = 24
 
 class Image(object):
-    _cache = {}
-    __slots__ = ("image", "filename", "convert", "has_alpha", "_spec")
+    __slots__ = ("image", "filename", "convert", "has_alpha")
 
     def __init__(self, filename, has_alpha=False, convert=True):
         self.filename = filename
         self.convert = convert
         self.has_alpha = has_alpha
-        self._spec = (filename, convert, has_alpha)
-        self.image = self._get_cache()
+        self.image = None
     # __init__()
 
 
-    def _set_cache(self):
-        self._cache[self._spec] = self.image
-    # _set_cache()
-
-
-    def _get_cache(self):
-        return self._cache.get(self._spec, None)
-    # _get_cache()
-
-
-    def _get_cache_raw(self):
-        return self._cache.get((self.filename, False, False), None)
-    # _get_cache_raw()
-
-
     def load(self):
         if self.image:
             return self.image
 
-        img = self._get_cache()
-        if img:
-            self.image = img
-            return img
-
-        img = self._get_cache_raw()
-        if not img:
-            img = pygame.image.load(self.filename)
-
+        img = surface_cache.load(self.filename)
         if self.convert:
-            if self.has_alpha:
-                img.set_alpha(255, RLEACCEL)
-                img = img.convert_alpha()
-            else:
-                img = img.convert()
+            img = surface_cache.get(img, has_alpha=self.has_alpha)
 
         self.image = img
-        self._set_cache()
         return img
     # load()
 
@@ -192,7 +163,8 @@ class BouncingSun(SmartSprite):
 
 
 class App(object):
-    def __init__(self, res=(800, 600), flags=0, depth=16, fps=24):
+    def __init__(self, res=(800, 600), flags=0, depth=16, fps=24,
+                 profile=False):
         self.screen = pygame.display.set_mode(res, flags, depth)
         self.run = False
         self.clock = None
@@ -203,6 +175,8 @@ class App(object):
         self.screen.fill(0)
         self.font = pygame.font.Font("font.ttf", 20)
         self.objs = SmartGroup()
+        if profile:
+            self.objs.enable_profiling()
         self.setup_gui()
         self.load_images()
     # __init__()
@@ -299,6 +273,11 @@ class App(object):
                 #print "dirty", self.clock.get_fps()
                 self.objs.clear(self.screen, self.bg)
                 r = self.objs.draw(self.screen)
+                if self.objs.profiler:
+                    o = self.objs.profiler.draw_overlay(self.screen,
+                                                        pos=(0, 40))
+                    if o:
+                        r.append(o)
                 pygame.display.update(r)
                 self.dirty = False
 
@@ -312,5 +291,7 @@ if __name__ == "__main__":
     pygame.init()
 
     flags = HWSURFACE | ASYNCBLIT
-    app = App(res=SCREEN_SIZE, flags=flags, depth=SCREEN_DEPTH, fps=FPS)
+    profile = "-p" in sys.argv or "--profile" in sys.argv
+    app = App(res=SCREEN_SIZE, flags=flags, depth=SCREEN_DEPTH, fps=FPS,
+              profile=profile)
     app.loop()
@@ -5,8 +5,18 @@ import argparse
 import subprocess
 import os.path
 from fnmatch import fnmatch
+from concurrent.futures import ProcessPoolExecutor
 import re
 
+try:
+    from elftools.elf.elffile import ELFFile
+    from elftools.elf.constants import SH_FLAGS
+    from elftools.elf.gnuversions import GNUVerDefSection, GNUVerNeedSection
+    from elftools.common.exceptions import ELFError
+except ImportError:
+    ELFFile = None # no pyelftools, use nm for everything
+
+
 class Symbol:
     __slots__ = ("type", "name", "version", "value", "is_global", "string")
 
@@ -89,6 +99,193 @@ class Symbol:
         }
 
 
+def split_version(sym):
+    """Split nm's "name@@version" or "name@version" into (name, version)."""
+    for sep in ("@@", "@"):
+        name, found, version = sym.partition(sep)
+        if found and name:
+            return name, version
+    return sym, None
+
+
+def read_nm_symbols(path, defined):
+    """Symbols as (type, name, version, value) using nm.
+
+    If defined, lists --defined-only --extern-only, otherwise
+    --undefined-only.
+    """
+    if defined:
+        nm_args = ("--defined-only", "--extern-only")
+    else:
+        nm_args = ("--undefined-only",)
+
+    symbols = []
+    pipe = subprocess.Popen(
+        ["nm", *nm_args, path],
+        stdout=subprocess.PIPE)
+    for line in pipe.stdout:
+        s = line.strip().decode("ascii").split()
+        if len(s) == 3:
+            value, type, sym = s
+        elif len(s) == 2:
+            value = None
+            type, sym = s
+        else:
+            continue # archive member header or empty line
+
+        name, version = split_version(sym)
+        symbols.append((type, name, version, value))
+
+    pipe.wait()
+    if pipe.returncode != 0:
+        raise SystemError("'nm %s %s' exit code: %s"
+                          % (" ".join(nm_args), path, pipe.returncode))
+    return symbols
+
+
+def _elf_symbol_type(elf, sym):
+    """nm's symbol type letter."""
+    shndx = sym["st_shndx"]
+    bind = sym["st_info"]["bind"]
+    stype = sym["st_info"]["type"]
+
+    if shndx == "SHN_UNDEF":
+        if bind == "STB_WEAK":
+            return "v" if stype == "STT_OBJECT" else "w"
+        return "U"
+    if stype in ("STT_GNU_IFUNC", "STT_LOOS"): # pyelftools names it LOOS
+        return "i"
+    if bind in ("STB_GNU_UNIQUE", "STB_LOOS"): # pyelftools names it LOOS
+        return "u"
+    if bind == "STB_WEAK":
+        return "V" if stype == "STT_OBJECT" else "W"
+
+    if shndx == "SHN_ABS":
+        type = "a"
+    elif shndx == "SHN_COMMON":
+        type = "c"
+    elif isinstance(shndx, int):
+        section = elf.get_section(shndx)
+        flags = section["sh_flags"]
+        if flags & SH_FLAGS.SHF_EXECINSTR:
+            type = "t"
+        elif not flags & SH_FLAGS.SHF_ALLOC:
+            type = "n"
+        elif not flags & SH_FLAGS.SHF_WRITE:
+            type = "r"
+        elif section["sh_type"] == "SHT_NOBITS":
+            type = "b"
+        else:
+            type = "d"
+    else:
+        type = "?"
+
+    if bind != "STB_LOCAL":
+        type = type.upper()
+    return type
+
+
+def _elf_dynsym_versions(elf):
+    """Symbol index -> version name, from .gnu.version sections."""
+    versym = elf.get_section_by_name(".gnu.version")
+    if versym is None:
+        return {}
+
+    names = {}
+    for section in elf.iter_sections():
+        if isinstance(section, GNUVerDefSection):
+            for verdef, verdaux in section.iter_versions():
+                for aux in verdaux:
+                    names[verdef["vd_ndx"]] = aux.name
+                    break
+        elif isinstance(section, GNUVerNeedSection):
+            for verneed, vernaux in section.iter_versions():
+                for aux in vernaux:
+                    names[aux["vna_other"]] = aux.name
+
+    versions = {}
+    for i in range(versym.num_symbols()):
+        ndx = versym.get_symbol(i)["ndx"]
+        if isinstance(ndx, int):
+            version = names.get(ndx & 0x7fff) # 0x8000 is the hidden bit
+            if version:
+                versions[i] = version
+    return versions
+
+
+def read_elf_symbols(path, defined):
+    """Same as read_nm_symbols(), reading the ELF file directly.
+
+    .symtab is used, as nm does. Stripped files have just .dynsym, that
+    is used instead (like nm -D) and versions come from .gnu.version;
+    version definitions (ie: ZLIB_1.2.0) are skipped, as they are not
+    C symbols.
+    """
+    symbols = []
+    with open(path, "rb") as f:
+        try:
+            elf = ELFFile(f)
+            symtab = elf.get_section_by_name(".symtab")
+            versions = {}
+            if symtab is None:
+                symtab = elf.get_section_by_name(".dynsym")
+                if symtab is None:
+                    return symbols
+                versions = _elf_dynsym_versions(elf)
+
+            value_fmt = "%%0%dx" % (elf.elfclass // 4)
+            for i, sym in enumerate(symtab.iter_symbols()):
+                if not sym.name:
+                    continue
+                if sym["st_info"]["type"] in ("STT_FILE", "STT_SECTION"):
+                    continue
+
+                undefined = sym["st_shndx"] == "SHN_UNDEF"
+                if defined:
+                    if undefined or sym["st_info"]["bind"] == "STB_LOCAL":
+                        continue
+                    value = value_fmt % sym["st_value"]
+                else:
+                    if not undefined:
+                        continue
+                    value = None
+
+                name, version = split_version(sym.name)
+                if version is None:
+                    version = versions.get(i)
+                    if version == name and sym["st_shndx"] == "SHN_ABS":
+                        continue # version definition, not a C symbol
+                symbols.append((_elf_symbol_type(elf, sym), name, version,
+                                value))
+        except ELFError as e:
+            raise SystemError("invalid ELF file %s: %s" % (path, e))
+    return symbols
+
+
+def is_elf(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(4) == b"\x7fELF"
+    except OSError:
+        return False # let nm report it
+
+
+def read_symbols(path, defined):
+    """ELF files are read directly if pyelftools is available, others
+    (ie: static archives) use nm.
+    """
+    if ELFFile is not None and is_elf(path):
+        return read_elf_symbols(path, defined)
+    return read_nm_symbols(path, defined)
+
+
+def _read_user_symbols_job(path):
+    try:
+        return read_symbols(os.path.realpath(path), False), None
+    except SystemError as e:
+        return None, e
+
+
 class Unit:
     def __init__(self, path, symbol_exclude):
         self.path = os.path.realpath(path)
@@ -97,24 +294,8 @@ class Unit:
         self.symbol_exclude = symbol_exclude or []
         self.excluded_symbols = []
 
-    def _read_nm(self, *nm_args):
-        pipe = subprocess.Popen(
-            ["nm", *nm_args, self.path],
-            stdout=subprocess.PIPE)
-        for line in pipe.stdout:
-            s = line.strip().decode("ascii").split()
-            if len(s) == 3:
-                value, type, sym = s
-            else:
-                value = None
-                type, sym = s
-
-            try:
-                name, version = sym.split("@@")
-            except:
-                name = sym
-                version = None
-
+    def _add_symbols(self, symbols):
+        for type, name, version, value in symbols:
             if name in ("_fini", "_init"):
                 continue
 
@@ -126,11 +307,6 @@ class Unit:
             else:
                 self.symbols[name] = sym
 
-        pipe.wait()
-        if pipe.returncode != 0:
-            raise SystemError("'nm %s %s' exit code: %s"
-                              % (" ".join(nm_args), self.path, pipe.returncode))
-
     def __hash__(self):
         return hash(self.path)
 
@@ -172,9 +348,11 @@ class Unit:
 
 
 class User(Unit):
-    def __init__(self, path, symbol_exclude):
+    def __init__(self, path, symbol_exclude, symbols=None):
         Unit.__init__(self, path, symbol_exclude)
-        self._read_nm("--undefined-only")
+        if symbols is None:
+            symbols = read_symbols(self.path, False)
+        self._add_symbols(symbols)
 
     def to_dict(self, include_symbols=True):
         r = {"path": self.path,
@@ -195,7 +373,7 @@ class Library(Unit):
         self.non_users = set()
         self.used_symbols = {}
         self.source_references = []
-        self._read_nm("--defined-only", "--extern-only")
+        self._add_symbols(read_symbols(self.path, True))
         self._match_used_symbols_re = None
 
     def add_user(self, u):
@@ -406,6 +584,10 @@ if __name__ == "__main__":
         "-x", "--symbol-exclude", action="append",
         default=[],
         help=("Symbol name exclude (fnmatch/glob pattern)."))
+    ap.add_argument(
+        "-j", "--jobs", type=int, default=0,
+        help=("Read users using this many processes, "
+              "0 = number of CPUs. Default=%(default)s"))
     ap.add_argument(
         "library",
         help="The library to use as symbol provider")
@@ -421,13 +603,20 @@ if __name__ == "__main__":
         sys.stderr.write("ERROR: invalid file %s (%s)\n" % (args.library, e))
         sys.exit(1)
 
-    for path in args.users:
-        try:
-            u = User(path, args.symbol_exclude)
-        except SystemError as e:
+    jobs = args.jobs or os.cpu_count() or 1
+    if jobs > 1 and len(args.users) > 1:
+        chunksize = max(1, len(args.users) // (4 * jobs))
+        with ProcessPoolExecutor(jobs) as executor:
+            results = list(executor.map(_read_user_symbols_job, args.users,
+                                        chunksize=chunksize))
+    else:
+        results = map(_read_user_symbols_job, args.users)
+
+    for path, (symbols, e) in zip(args.users, results):
+        if e is not None:
             sys.stderr.write("ERROR: invalid file %s (%s)\n" % (path, e))
             continue
-        lib.add_user(u)
+        lib.add_user(User(path, args.symbol_exclude, symbols))
 
     extensions = set()
     for e in args.source_extension:
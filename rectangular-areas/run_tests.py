@@ -0,0 +1,213 @@
+#!/usr/bin/python
+
+"""Headless check and benchmark of split.py splitters.
+
+Every splitter (python, grid and C if librect_splitter.so is built) is
+run over tests.cases with split_strict(), add() and add_many(), output
+must not overlap more than accepted_error and must cover the union of
+inputs, adding no more than accepted_error for each input.
+
+Then all of them are timed with random rectangle sets.
+"""
+
+import sys
+import random
+import optparse
+from timeit import default_timer
+
+import split
+from split import Rect
+from tests import cases
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+
+def get_splitters():
+    splitters = [("python", split.PyRectSplitter),
+                 ("grid", split.GridRectSplitter)]
+    if split._lib is not None:
+        splitters.append(("c", split.CRectSplitter))
+    return splitters
+
+
+def run_mode(splitter, mode, rects, accepted_error):
+    s = splitter()
+    if mode == "split_strict":
+        for r in rects:
+            s.split_strict(Rect(r))
+    elif mode == "add":
+        for r in rects:
+            s.add(Rect(r), accepted_error)
+    elif mode == "add_many":
+        s.add_many([Rect(r) for r in rects], accepted_error)
+    else:
+        raise ValueError("unknown mode: %s" % mode)
+    return s.rects
+
+
+def coverage(rects):
+    """Number of pixels covered by rects."""
+    if not rects:
+        return 0
+    left = min([r[0] for r in rects])
+    top = min([r[1] for r in rects])
+    w = max([r[0] + r[2] for r in rects]) - left
+    h = max([r[1] + r[3] for r in rects]) - top
+
+    pixels = bytearray(w * h)
+    for x, y, rw, rh in rects:
+        x -= left
+        y -= top
+        for row in xrange(y, y + rh):
+            base = row * w
+            for i in xrange(base + x, base + x + rw):
+                pixels[i] = 1
+    return pixels.count("\1")
+
+
+def check(rects, result, accepted_error):
+    """Returns list of errors, empty if result is fine."""
+    errors = []
+    result = [tuple(r) for r in result]
+    union = coverage(list(rects))
+    covered = coverage(result)
+    both = coverage(list(rects) + result)
+
+    if both != covered:
+        errors.append("%d input pixels not covered" % (both - covered))
+    extra = covered - union
+    if extra > accepted_error * len(rects):
+        errors.append("%d extra pixels" % extra)
+
+    for i, a in enumerate(result):
+        a = Rect(a)
+        for b in result[i + 1:]:
+            c = a.clip(b)
+            if c.width * c.height > accepted_error:
+                errors.append("%s overlaps %s" % (a, Rect(b)))
+    return errors
+
+
+def run_checks(accepted_errors, verbose=False):
+    results = {}
+    failures = 0
+    for sname, splitter in get_splitters():
+        for mode in ("split_strict", "add", "add_many"):
+            errs = accepted_errors
+            if mode == "split_strict":
+                errs = (0,)
+            for accepted_error in errs:
+                key = "%s/%s/%d" % (sname, mode, accepted_error)
+                failed = {}
+                for name, rects in cases:
+                    result = run_mode(splitter, mode, rects, accepted_error)
+                    errors = check(rects, result, accepted_error)
+                    if errors:
+                        failed[name] = errors
+                results[key] = {"passed": len(cases) - len(failed),
+                                "failed": failed}
+                failures += len(failed)
+
+                print "%-30s %3d passed, %3d failed" % \
+                      (key, len(cases) - len(failed), len(failed))
+                if verbose:
+                    for name in sorted(failed):
+                        print "    %s: %s" % (name, "; ".join(failed[name]))
+    return results, failures
+
+
+def random_rects(n, size, max_side, seed):
+    rng = random.Random(seed)
+    w, h = size
+    rects = []
+    for i in xrange(n):
+        rw = rng.randint(1, max_side)
+        rh = rng.randint(1, max_side)
+        rects.append((rng.randint(0, w - rw), rng.randint(0, h - rh),
+                      rw, rh))
+    return rects
+
+
+def run_bench(counts, accepted_error, size, max_side, seed, max_time):
+    results = {}
+    slow = set()
+    for n in counts:
+        rects = random_rects(n, size, max_side, seed)
+        results[n] = {}
+        for sname, splitter in get_splitters():
+            for mode in ("split_strict", "add", "add_many"):
+                key = "%s/%s" % (sname, mode)
+                if key in slow:
+                    continue
+                t0 = default_timer()
+                out = run_mode(splitter, mode, rects, accepted_error)
+                t = default_timer() - t0
+                results[n][key] = {"time": t, "rects": len(out)}
+                print "%6d %-20s %9.4fs %6d rects" % (n, key, t, len(out))
+                if max_time and t > max_time:
+                    # do not try bigger sets, would take too long
+                    slow.add(key)
+    return results
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-e", "--accepted-error", type="int", action="append",
+                      default=[], help="accepted error to check, may be "
+                      "repeated [0 and 300]")
+    parser.add_option("-n", "--count", type="int", action="append",
+                      default=[], help="benchmark rect count, may be "
+                      "repeated [100, 1000 and 5000]")
+    parser.add_option("-s", "--seed", type="int", default=0,
+                      help="random seed [%default]")
+    parser.add_option("-S", "--size", default="2000x2000",
+                      help="area of random rects [%default]")
+    parser.add_option("-m", "--max-side", type="int", default=64,
+                      help="maximum random rect side [%default]")
+    parser.add_option("-t", "--max-time", type="float", default=10.0,
+                      help="skip bigger sets for slower runs [%default]")
+    parser.add_option("-B", "--no-bench", action="store_true",
+                      default=False, help="just check")
+    parser.add_option("-v", "--verbose", action="store_true",
+                      default=False, help="show failure details")
+    parser.add_option("-j", "--json", default=None,
+                      help="write JSON report to file")
+    options, args = parser.parse_args()
+
+    try:
+        size = tuple([int(v) for v in options.size.split("x")])
+    except ValueError, e:
+        parser.error("invalid size: %s" % options.size)
+
+    report = {"splitters": [name for name, s in get_splitters()]}
+    checks, failures = run_checks(options.accepted_error or (0, 300),
+                                  options.verbose)
+    report["checks"] = checks
+    report["failures"] = failures
+
+    if not options.no_bench:
+        report["bench"] = run_bench(options.count or (100, 1000, 5000),
+                                    300, size, options.max_side,
+                                    options.seed, options.max_time)
+
+    if options.json:
+        if json is None:
+            raise SystemExit("No JSON support, install simplejson")
+        f = open(options.json, "w")
+        try:
+            json.dump(report, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,155 @@
 Split given rectangles so rectangles don't overlap.
 """
 
+import os
 import heapq
+import random
+import ctypes
+import ctypes.util
+from timeit import default_timer
+from collections import deque
 from pygame import Rect
+import pygame
+
+
+class CostModel(object):
+    """Predicted time to update a set of rectangles: rect_cost for each
+    rectangle plus pixel_cost for each pixel, in seconds.
+
+    Merging two rectangles saves one rect_cost and copies the extra
+    pixels of the outer rectangle, so it is worth when these are less
+    than rect_cost / pixel_cost. The same goes for keeping two
+    rectangles overlapped instead of splitting them. This is used as
+    accepted_error by RectSplitter.add().
+
+    Use calibrate() to measure costs of the actual display.
+    """
+    def __init__(self, rect_cost=3e-6, pixel_cost=1e-8):
+        self.rect_cost = rect_cost
+        self.pixel_cost = pixel_cost
+
+    def cost(self, rects):
+        pixels = 0
+        for r in rects:
+            pixels += r.width * r.height
+        return len(rects) * self.rect_cost + pixels * self.pixel_cost
+
+    def accepted_error(self):
+        """Extra pixels that cost less than one more rectangle."""
+        if self.pixel_cost <= 0:
+            return 0
+        return max(0, int(self.rect_cost / self.pixel_cost) - 1)
+
+    def calibrate(self, update=None, size=None, sides=(1, 4, 16, 64, 128),
+                  count=100, repeat=3):
+        """Set costs from time taken by update(rects) with count squares
+        of each given side, fitted with least squares. Default is to
+        use pygame.display.update() on current display.
+
+        Returns (rect_cost, pixel_cost).
+        """
+        if update is None:
+            screen = pygame.display.get_surface()
+            if screen is None:
+                raise ValueError("no display, give update function")
+            update = pygame.display.update
+            if size is None:
+                size = screen.get_size()
+        if size is None:
+            raise ValueError("size is required with custom update")
+
+        w, h = size
+        rng = random.Random(0)
+        samples = []
+        for side in sides:
+            side = min(side, w, h)
+            rects = [Rect(rng.randint(0, w - side), rng.randint(0, h - side),
+                          side, side) for i in xrange(count)]
+            best = None
+            for i in xrange(repeat):
+                t0 = default_timer()
+                update(rects)
+                t = default_timer() - t0
+                if best is None or t < best:
+                    best = t
+            samples.append((side * side, best / count))
+
+        n = float(len(samples))
+        mean_x = sum([x for x, y in samples]) / n
+        mean_y = sum([y for x, y in samples]) / n
+        sxx = sum([(x - mean_x) ** 2 for x, y in samples])
+        sxy = sum([(x - mean_x) * (y - mean_y) for x, y in samples])
+        if sxx > 0:
+            pixel_cost = sxy / sxx
+        else:
+            pixel_cost = 0.0
+        pixel_cost = max(pixel_cost, 1e-12)
+        rect_cost = max(mean_y - pixel_cost * mean_x, 0.0)
+
+        self.rect_cost = rect_cost
+        self.pixel_cost = pixel_cost
+        return rect_cost, pixel_cost
+# CostModel
+
+
+def _accepted_error(cost_model):
+    if cost_model is None:
+        return 0
+    return cost_model.accepted_error()
+
+
+def sweep_cover(rects):
+    """Non-overlapping rectangles covering exactly the union of rects.
+
+    Sweeps a vertical line over sorted left/right edges. Between two
+    edges the union of y intervals of active rectangles is computed,
+    intervals also present in the previous slab are extended instead of
+    starting new rectangles.
+    """
+    events = {}
+    for r in rects:
+        if r.width <= 0 or r.height <= 0:
+            continue
+        span = (r.top, r.bottom)
+        events.setdefault(r.left, []).append((span, 1))
+        events.setdefault(r.right, []).append((span, -1))
+
+    R = Rect
+    result = []
+    active = {}
+    opened = {}
+    for x in sorted(events):
+        for span, d in events[x]:
+            n = active.get(span, 0) + d
+            if n:
+                active[span] = n
+            else:
+                del active[span]
+
+        spans = []
+        for top, bottom in sorted(active):
+            if spans and top <= spans[-1][1]:
+                if bottom > spans[-1][1]:
+                    spans[-1][1] = bottom
+            else:
+                spans.append([top, bottom])
+
+        current = {}
+        for top, bottom in spans:
+            span = (top, bottom)
+            current[span] = opened.pop(span, x)
+
+        for (top, bottom), start in opened.iteritems():
+            result.append(R(start, top, x - start, bottom - top))
+        opened = current
+
+    return result
+
 
 class RectSplitter(object):
-    def __init__(self):
+    def __init__(self, cost_model=None):
         self.rects = []
+        self.cost_model = cost_model
 
     def split_strict(self, r):
         """Split rectangles strictly, no merge is done and already existing
@@ -343,8 +486,498 @@ class RectSplitter(object):
                 # not merged with any, add to rects
                 rects.append(r1)
 
-    def add(self, r, accepted_error=0):
+    def add(self, r, accepted_error=None):
+        """Add rectangle, merging with others if area grows up to
+        accepted_error pixels. If None, it comes from cost_model.
+        """
+        if accepted_error is None:
+            accepted_error = _accepted_error(self.cost_model)
         idx = len(self.rects)
         idx -= self._split(r, accepted_error)
         self._merge(idx, accepted_error)
+
+    def add_many(self, rects, accepted_error=None):
+        """Add all rectangles at once, faster than add() for each.
+
+        Existing and given rectangles are replaced by sweep_cover() of
+        them, which are then merged as add() would do.
+        """
+        if accepted_error is None:
+            accepted_error = _accepted_error(self.cost_model)
+        self.rects = sweep_cover(self.rects + list(rects))
+        self._merge(0, accepted_error)
 # RectSplitter
+
+
+class GridRectSplitter(object):
+    """Same as RectSplitter.add() and RectSplitter.split_strict(), but
+    rectangles are kept in a uniform grid, so just those in cells near
+    the new one are checked instead of all of them.
+
+    Rectangles are kept by increasing key, so order (and output) is the
+    same as RectSplitter.
+    """
+    def __init__(self, cell_size=64, cost_model=None):
+        self.cell_size = cell_size
+        self.cost_model = cost_model
+        self._items = {}
+        self._cells = {}
+        self._next_key = 0
+
+    def _get_rects(self):
+        items = self._items
+        return [items[k] for k in sorted(items)]
+    rects = property(_get_rects)
+
+    def __len__(self):
+        return len(self._items)
+
+    def _cell_range(self, left, top, right, bottom):
+        cs = self.cell_size
+        if right <= left:
+            right = left + 1
+        if bottom <= top:
+            bottom = top + 1
+        return (left // cs, top // cs, (right - 1) // cs, (bottom - 1) // cs)
+
+    def _insert(self, r):
+        key = self._next_key
+        self._next_key += 1
+        self._items[key] = r
+
+        cells = self._cells
+        x0, y0, x1, y1 = self._cell_range(r.left, r.top, r.right, r.bottom)
+        for y in xrange(y0, y1 + 1):
+            for x in xrange(x0, x1 + 1):
+                c = cells.get((x, y))
+                if c is None:
+                    cells[(x, y)] = set((key,))
+                else:
+                    c.add(key)
+        return key
+
+    def _remove(self, key):
+        r = self._items.pop(key)
+
+        cells = self._cells
+        x0, y0, x1, y1 = self._cell_range(r.left, r.top, r.right, r.bottom)
+        for y in xrange(y0, y1 + 1):
+            for x in xrange(x0, x1 + 1):
+                c = cells[(x, y)]
+                c.discard(key)
+                if not c:
+                    del cells[(x, y)]
+        return r
+
+    def _query(self, r, accepted_error=0):
+        """Keys, in order, of rectangles that may touch r or be merged
+        with it. Rectangles at distance d from r add at least d times r
+        width or height to merged area, so just look accepted_error
+        divided by that further.
+        """
+        dx = accepted_error // max(r.height, 1) + 1
+        dy = accepted_error // max(r.width, 1) + 1
+        x0, y0, x1, y1 = self._cell_range(r.left - dx, r.top - dy,
+                                          r.right + dx, r.bottom + dy)
+        cells = self._cells
+        found = set()
+        for y in xrange(y0, y1 + 1):
+            for x in xrange(x0, x1 + 1):
+                c = cells.get((x, y))
+                if c:
+                    found.update(c)
+        return sorted(found)
+
+    def split_strict(self, r):
+        """Split rectangles strictly, no merge is done and already existing
+        rectangles are never modified.
+        """
+        items = self._items
+        R = Rect
+        dirty = [r]
+        for key in self._query(r):
+            if not dirty:
+                break
+
+            new_dirty = []
+            current = items[key]
+
+            for r in dirty:
+                max_left = max(r.left, current.left)
+                min_right = min(r.right, current.right)
+                max_top = max(r.top, current.top)
+                min_bottom = min(r.bottom, current.bottom)
+
+                intra_width = min_right - max_left
+                intra_height = min_bottom - max_top
+
+                if intra_width == r.width and intra_height == r.height:
+                    continue
+
+                if intra_width <= 0 or intra_height <= 0:
+                    new_dirty.append(r)
+                    continue
+
+                h_1 = current.top - r.top
+                h_2 = r.bottom - current.bottom
+                w_1 = current.left - r.left
+                w_2 = r.right - current.right
+
+                if h_1 > 0:
+                    new_dirty.append(R(r.left, r.top, r.width, h_1))
+                    r.height -= h_1
+                    r.top = current.top
+
+                if h_2 > 0:
+                    new_dirty.append(R(r.left, current.bottom, r.width, h_2))
+                    r.height -= h_2
+
+                if w_1 > 0:
+                    new_dirty.append(R(r.left, r.top, w_1, r.height))
+                    r.width -= w_1
+                    r.left = current.left
+
+                if w_2 > 0:
+                    new_dirty.append(R(current.right, r.top, w_2, r.height))
+                    r.width -= w_2
+
+            dirty = new_dirty
+
+        for r in dirty:
+            self._insert(r)
+
+    def _split(self, r, accepted_error=0):
+        """See RectSplitter._split(), returns number of added rectangles."""
+        items = self._items
+        remove = self._remove
+        R = Rect
+        added = 0
+        dirty = deque((r,))
+        while dirty:
+            r = dirty.popleft()
+            for key in self._query(r, accepted_error):
+                current = items[key]
+
+                if r.left < current.left:
+                    max_left = current.left
+                    min_left = r.left
+                else:
+                    max_left = r.left
+                    min_left = current.left
+
+                if r.right < current.right:
+                    min_right = r.right
+                    max_right = current.right
+                else:
+                    min_right = current.right
+                    max_right = r.right
+
+                if r.top < current.top:
+                    max_top = current.top
+                    min_top = r.top
+                else:
+                    max_top = r.top
+                    min_top = current.top
+
+                if r.bottom < current.bottom:
+                    min_bottom = r.bottom
+                    max_bottom = current.bottom
+                else:
+                    min_bottom = current.bottom
+                    max_bottom = r.bottom
+
+                intra_width = min_right - max_left
+                intra_height = min_bottom - max_top
+
+                if intra_width == r.width and intra_height == r.height:
+                    # r inside current
+                    break
+
+                if intra_width == current.width and \
+                   intra_height == current.height:
+                    # current inside r
+                    remove(key)
+                    continue
+
+                if intra_width > 0 and intra_height > 0:
+                    intra_area = intra_width * intra_height
+                else:
+                    intra_area = 0
+
+                current_area = current.width * current.height
+                r_area = r.width * r.height
+
+                outer_width = max_right - min_left
+                outer_height = max_bottom - min_top
+                outer_area = outer_width * outer_height
+
+                area = current_area + r_area - intra_area
+                if outer_area - area <= accepted_error:
+                    # merge them, remove both and add merged
+                    remove(key)
+                    current.left = min_left
+                    current.top = min_top
+                    current.width = outer_width
+                    current.height = outer_height
+                    dirty.append(current)
+                    break
+
+                if intra_area <= accepted_error:
+                    # no split, no merge
+                    continue
+
+                h_1 = current.top - r.top
+                h_2 = r.bottom - current.bottom
+                w_1 = current.left - r.left
+                w_2 = r.right - current.right
+
+                split = False
+
+                if h_1 > 0:
+                    dirty.append(R(r.left, r.top, r.width, h_1))
+                    r.height -= h_1
+                    r.top = current.top
+                    split = True
+
+                if h_2 > 0:
+                    dirty.append(R(r.left, current.bottom, r.width, h_2))
+                    r.height -= h_2
+                    split = True
+
+                if (w_1 > 0 or w_2 > 0) and current.height == r.height:
+                    # merge them
+                    remove(key)
+                    current.left = min_left
+                    current.width = outer_width
+                    dirty.append(current)
+                    break
+
+                if w_1 > 0:
+                    dirty.append(R(r.left, r.top, w_1, r.height))
+                    r.width -= w_1
+                    r.left = current.left
+                    split = True
+
+                if w_2 > 0:
+                    dirty.append(R(current.right, r.top, w_2, r.height))
+                    r.width -= w_2
+                    split = True
+
+                if split:
+                    break
+            else:
+                self._insert(r)
+                added += 1
+
+        return added
+
+    def _merge(self, count, accepted_error=0):
+        """See RectSplitter._merge(), merges the last count rectangles."""
+        items = self._items
+        remove = self._remove
+        keys = []
+        key = self._next_key
+        while len(keys) < count and key > 0:
+            key -= 1
+            if key in items:
+                keys.append(key)
+        keys.reverse()
+        to_merge = deque([remove(k) for k in keys])
+        while to_merge:
+            r1 = to_merge.popleft()
+            r1_area = r1.width * r1.height
+
+            for key in self._query(r1, accepted_error):
+                r2 = items[key]
+                r2_area = r2.width * r2.height
+
+                if r1.left < r2.left:
+                    min_left = r1.left
+                else:
+                    min_left = r2.left
+
+                if r1.right > r2.right:
+                    max_right = r1.right
+                else:
+                    max_right = r2.right
+
+                if r1.top < r2.top:
+                    min_top = r1.top
+                else:
+                    min_top = r2.top
+
+                if r1.bottom > r2.bottom:
+                    max_bottom = r1.bottom
+                else:
+                    max_bottom = r2.bottom
+
+                outer_width = max_right - min_left
+                outer_height = max_bottom - min_top
+                outer_area = outer_width * outer_height
+
+                area = r1_area + r2_area
+
+                if outer_area - area <= accepted_error:
+                    remove(key)
+                    r1.left = min_left
+                    r1.top = min_top
+                    r1.width = outer_width
+                    r1.height = outer_height
+                    to_merge.append(r1)
+                    break
+            else:
+                # not merged with any, add to rects
+                self._insert(r1)
+
+    def add(self, r, accepted_error=None):
+        if accepted_error is None:
+            accepted_error = _accepted_error(self.cost_model)
+        self._merge(self._split(r, accepted_error), accepted_error)
+
+    def add_many(self, rects, accepted_error=None):
+        """See RectSplitter.add_many()."""
+        if accepted_error is None:
+            accepted_error = _accepted_error(self.cost_model)
+        cover = sweep_cover(self.rects + list(rects))
+        self._items.clear()
+        self._cells.clear()
+        for r in cover:
+            self._insert(r)
+        self._merge(len(cover), accepted_error)
+# GridRectSplitter
+
+
+class _CRect(ctypes.Structure):
+    _fields_ = [("left", ctypes.c_short),
+                ("top", ctypes.c_short),
+                ("right", ctypes.c_short),
+                ("bottom", ctypes.c_short),
+                ("width", ctypes.c_short),
+                ("height", ctypes.c_short),
+                ("area", ctypes.c_int)]
+
+
+class _CListNode(ctypes.Structure):
+    pass
+_CListNode._fields_ = [("next", ctypes.POINTER(_CListNode))]
+
+
+class _CList(ctypes.Structure):
+    _fields_ = [("head", ctypes.POINTER(_CListNode)),
+                ("tail", ctypes.POINTER(_CListNode))]
+
+
+class _CRectNode(ctypes.Structure):
+    _fields_ = [("_lst", _CListNode),
+                ("rect", _CRect)]
+
+
+def _load_library():
+    """Load librect_splitter.so (see Makefile) from $RECT_SPLITTER_LIB,
+    this directory or system paths. Returns None if not found.
+    """
+    names = [os.environ.get("RECT_SPLITTER_LIB"),
+             os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "librect_splitter.so"),
+             ctypes.util.find_library("rect_splitter")]
+    for name in names:
+        if not name:
+            continue
+        try:
+            lib = ctypes.CDLL(name)
+        except OSError, e:
+            continue
+
+        plist = ctypes.POINTER(_CList)
+        pnode = ctypes.POINTER(_CListNode)
+        c_int = ctypes.c_int
+        lib.rect_list_append_xywh.argtypes = (plist, c_int, c_int,
+                                              c_int, c_int)
+        lib.rect_list_append_xywh.restype = None
+        lib.rect_list_add_split_strict.argtypes = (plist, pnode)
+        lib.rect_list_add_split_strict.restype = None
+        lib.rect_list_add_split_fuzzy_and_merge.argtypes = (plist, pnode,
+                                                            c_int, c_int)
+        lib.rect_list_add_split_fuzzy_and_merge.restype = None
+        lib.rect_list_merge_rects.argtypes = (plist, plist, c_int)
+        lib.rect_list_merge_rects.restype = None
+        lib.rect_list_clear.argtypes = (plist,)
+        lib.rect_list_clear.restype = None
+        return lib
+    return None
+
+_lib = _load_library()
+
+
+class CRectSplitter(object):
+    """RectSplitter implemented by rect_splitter.c, used through ctypes.
+
+    Coordinates are C shorts. Rectangles are kept in C, so rects is a
+    new list of copies, changing them does nothing.
+    """
+    def __init__(self, cost_model=None):
+        if _lib is None:
+            raise RuntimeError("librect_splitter.so not found, "
+                               "run: make librect_splitter.so")
+        self._lib = _lib
+        self._list = _CList()
+        self.cost_model = cost_model
+
+    def __del__(self):
+        # __init__() may have failed before setting _lib
+        lib = getattr(self, "_lib", None)
+        if lib is not None:
+            lib.rect_list_clear(ctypes.byref(self._list))
+
+    def _get_rects(self):
+        rects = []
+        node = self._list.head
+        while node:
+            r = ctypes.cast(node, ctypes.POINTER(_CRectNode)).contents.rect
+            rects.append(Rect(r.left, r.top, r.width, r.height))
+            node = node.contents.next
+        return rects
+    rects = property(_get_rects)
+
+    def _append(self, lst, r):
+        self._lib.rect_list_append_xywh(ctypes.byref(lst), r.left, r.top,
+                                        r.width, r.height)
+
+    def _node(self, r):
+        lst = _CList()
+        self._append(lst, r)
+        return lst.head
+
+    def clear(self):
+        self._lib.rect_list_clear(ctypes.byref(self._list))
+
+    def split_strict(self, r):
+        self._lib.rect_list_add_split_strict(ctypes.byref(self._list),
+                                             self._node(r))
+
+    def add(self, r, accepted_error=None):
+        if accepted_error is None:
+            accepted_error = _accepted_error(self.cost_model)
+        self._lib.rect_list_add_split_fuzzy_and_merge(
+            ctypes.byref(self._list), self._node(r),
+            accepted_error, accepted_error)
+
+    def add_many(self, rects, accepted_error=None):
+        """See RectSplitter.add_many()."""
+        if accepted_error is None:
+            accepted_error = _accepted_error(self.cost_model)
+        cover = sweep_cover(self.rects + list(rects))
+        self.clear()
+        to_merge = _CList()
+        for r in cover:
+            self._append(to_merge, r)
+        self._lib.rect_list_merge_rects(ctypes.byref(self._list),
+                                        ctypes.byref(to_merge),
+                                        accepted_error)
+# CRectSplitter
+
+
+# use C implementation if available, unless $SPLIT_PURE_PYTHON is set
+PyRectSplitter = RectSplitter
+if _lib is not None and not os.environ.get("SPLIT_PURE_PYTHON"):
+    RectSplitter = CRectSplitter
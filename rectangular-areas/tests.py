@@ -172,7 +172,8 @@ if __name__ == "__main__":
         dy = 50
         r_clear = Rect(dx, dy, max_x, max_y)
 
-        non_overlaps = split.RectSplitter()
+        # steps through _split() and _merge(), python only
+        non_overlaps = split.PyRectSplitter()
         for r in rects:
             print "ADD:", split.Rect(r)
             # 2 pass